@@ -0,0 +1,771 @@
+# benchmarks.py
+# timing harnesses for the lexer, parser and evaluators in simpleLanguage.py
+# usage: python benchmarks.py [name ...]   (no names runs them all)
+
+import contextlib, gc, io, os, sys, tempfile, time, tracemalloc
+import simpleLanguage
+
+def bestTime(fn, repeat=3):
+    # best wall-clock time of several runs, in seconds; like timeit, the
+    # cyclic garbage collector is paused so large ASTs don't skew results
+    best = None
+    for i in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        if (best == None or elapsed < best):
+            best = elapsed
+    return best
+
+def report(label, seconds, baseline=None):
+    line = "  %-40s %10.2f ms" % (label, seconds * 1000)
+    if (baseline != None):
+        line += "   %5.1fx" % (baseline / seconds)
+    print(line)
+
+##############################################
+## Lexer
+##############################################
+
+def benchLexer(scale=500):
+    code = simpleLanguage.code * scale
+    print("lexer: %d chars, %d tokens" %
+          (len(code), len(simpleLanguage.tokenize(code, "dfa"))))
+    baseline = bestTime(lambda: simpleLanguage.tokenize(code, "buffer"))
+    report("buffer engine", baseline)
+    report("dfa engine",
+           bestTime(lambda: simpleLanguage.tokenize(code, "dfa")), baseline)
+
+# the per-character scanners tokenizeInt/tokenizeId replaced, kept here
+# as the baseline for benchLexemes
+def naiveTokenizeInt(buffer):
+    result = 0
+    while (buffer.peek().isdigit()):
+        result = 10*result + int(buffer.get())
+    return simpleLanguage.Token(result)
+
+def naiveTokenizeId(buffer):
+    result = ""
+    while (buffer.peek().isalnum()):
+        result += buffer.get()
+    return simpleLanguage.Token(result)
+
+def benchLexemes(lengths=(200, 1000, 5000, 20000)):
+    print("lexemes: one identifier / one integer literal of each length")
+    for (kind, alphabet, naive, scanner) in [
+            ("id", "abcdefghij", naiveTokenizeId, simpleLanguage.tokenizeId),
+            ("int", "1234567890", naiveTokenizeInt, simpleLanguage.tokenizeInt)]:
+        for length in lengths:
+            text = (alphabet * (length // 10 + 1))[:length]
+            def scan(fn):
+                return lambda: fn(simpleLanguage.Buffer(text))
+            baseline = bestTime(scan(naive))
+            report("%s x%d per-char" % (kind, length), baseline)
+            report("%s x%d sliced" % (kind, length), bestTime(scan(scanner)),
+                   baseline)
+            report("%s x%d dfa" % (kind, length),
+                   bestTime(lambda: simpleLanguage.tokenize(text, "dfa")),
+                   baseline)
+
+def peakMemory(fn):
+    # peak bytes allocated while fn runs
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchStreaming(scale=500):
+    code = simpleLanguage.code * scale
+    print("streaming: %d chars read from a file object" % len(code))
+    def drain():
+        for token in simpleLanguage.iterTokens(io.StringIO(code)):
+            pass
+    for (label, fn) in [
+            ("tokenize (list)",
+             lambda: simpleLanguage.tokenize(code, "dfa")),
+            ("iterTokens (drained)", drain),
+            ("parseTopLevelBlock",
+             lambda: simpleLanguage.parseTopLevelBlock(code)),
+            ("parseStream",
+             lambda: simpleLanguage.parseStream(io.StringIO(code)))]:
+        print("  %-32s %10.2f ms   peak %8d KiB" %
+              (label, bestTime(fn, 1) * 1000, peakMemory(fn) // 1024))
+
+def benchMapped(scale=500):
+    code = simpleLanguage.code * scale
+    (fd, path) = tempfile.mkstemp(suffix=".simple")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(code)
+        print("mapped: %d byte script on disk" % len(code))
+        def readAndParse():
+            with open(path) as f:
+                return simpleLanguage.parseTopLevelBlock(f.read())
+        for (label, fn) in [
+                ("read + parseTopLevelBlock", readAndParse),
+                ("parseFile (mmap)",
+                 lambda: simpleLanguage.parseFile(path))]:
+            print("  %-32s %10.2f ms   peak %8d KiB" %
+                  (label, bestTime(fn, 1) * 1000, peakMemory(fn) // 1024))
+    finally:
+        os.remove(path)
+
+def benchCompact(scale=500):
+    code = simpleLanguage.code * scale
+    count = len(simpleLanguage.tokenize(code, "compact"))
+    print("compact: %d tokens" % count)
+    for engine in ["dfa", "compact"]:
+        tokens = [None]
+        def lex():
+            tokens[0] = simpleLanguage.tokenize(code, engine)
+        size = peakMemory(lex)
+        parse = lambda: simpleLanguage.parseTopLevelBuffer(
+            simpleLanguage.makeTokenBuffer(tokens[0]))
+        print("  %-10s %6.1f bytes/token   lex %8.2f ms   parse %8.2f ms" %
+              (engine, size / count, bestTime(lex) * 1000,
+               bestTime(parse) * 1000))
+
+##############################################
+## Parser
+##############################################
+
+def nestedBlocks(depth):
+    return "vars(x)\n" + "{ set x to x + 1 " * depth + "}" * depth
+
+def nestedCalls(depth):
+    return ("vars(f)\nset f to function(n) { return n + 1 }\n" +
+            "output " + "f(" * depth + "1" + ")" * depth)
+
+def benchPackrat(depth=60, repeat=200):
+    programs = [("nested blocks", nestedBlocks(depth) * repeat),
+                ("nested calls", nestedCalls(depth) * repeat),
+                ("sample program", simpleLanguage.code * repeat)]
+    print("packrat: %d copies of each program, nesting depth %d" %
+          (repeat, depth))
+    for (label, code) in programs:
+        tokens = simpleLanguage.tokenize(code, "dfa")
+        def parse(packrat):
+            return lambda: simpleLanguage.parseTopLevelBuffer(
+                simpleLanguage.makeTokenBuffer(tokens, packrat, False))
+        baseline = bestTime(parse(False))
+        report(label + ", backtracking", baseline)
+        report(label + ", packrat", bestTime(parse(True)), baseline)
+
+def benchPredictive(scale=10000):
+    code = simpleLanguage.code * scale
+    tokens = simpleLanguage.tokenize(code, "compact")
+    print("predictive: sample program x%d, %d tokens" % (scale, len(tokens)))
+    def parse(predictive):
+        return lambda: simpleLanguage.parseTopLevelBuffer(
+            simpleLanguage.makeTokenBuffer(tokens, False, predictive))
+    baseline = bestTime(parse(False), 1)
+    report("backtracking", baseline)
+    report("LL(1) dispatch", bestTime(parse(True), 1), baseline)
+
+##############################################
+## AST
+##############################################
+
+def walkTree(node):
+    nodes = [node]
+    for node in nodes:
+        nodes.extend(node.getChildren())
+    return nodes
+
+class DictNode(object):
+    # the layout nodes had before __slots__: attributes in a __dict__ and
+    # the children in a list
+    pass
+
+def toDictNodes(node):
+    mirror = DictNode()
+    mirror.children = [toDictNodes(child) for child in node.getChildren()]
+    for name in ["id", "value", "op", "fn", "ids"]:
+        if (hasattr(node, name)):
+            setattr(mirror, name, getattr(node, name))
+    if (hasattr(node, "ids")):
+        mirror.ids = list(node.ids)
+    return mirror
+
+def retainedMemory(fn):
+    # bytes still allocated by fn's result once it returns
+    tracemalloc.start()
+    try:
+        result = fn() # alive until it has been measured
+        retained = tracemalloc.get_traced_memory()[0]
+        del result
+        return retained
+    finally:
+        tracemalloc.stop()
+
+def benchNodeMemory(scale=2000):
+    code = simpleLanguage.code * scale
+    tokens = simpleLanguage.tokenize(code, "compact")
+    ast = simpleLanguage.parseTopLevelBuffer(
+        simpleLanguage.makeTokenBuffer(tokens))
+    count = len(walkTree(ast))
+    print("node memory: sample program x%d, %d nodes" % (scale, count))
+    before = retainedMemory(lambda: toDictNodes(ast))
+    after = retainedMemory(lambda: simpleLanguage.parseTopLevelBuffer(
+        simpleLanguage.makeTokenBuffer(tokens)))
+    print("  %-32s %6.1f bytes/node" % ("__dict__ + child list", before / count))
+    print("  %-32s %6.1f bytes/node   %5.1fx" %
+          ("__slots__ + named fields", after / count, before / after))
+
+##############################################
+## Evaluator
+##############################################
+
+def evalQuietly(ast):
+    # evaluate a top-level block in fresh globals, discarding its output
+    with contextlib.redirect_stdout(io.StringIO()):
+        return ast.eval(simpleLanguage.Context())
+
+CALL_PROGRAMS = [
+    ("rfib(15)", """
+vars(rfib)
+set rfib to function(n) {
+    if n is 0 then { return 1 }
+    if n is 1 then { return 1 }
+    return rfib(n-1) + rfib(n-2)
+}
+output rfib(15)
+"""),
+    ("ackermann(2 3)", """
+vars(ack)
+set ack to function(m n) {
+    if m is 0 then { return n + 1 }
+    if n is 0 then { return ack(m-1 1) }
+    return ack(m-1 ack(m n-1))
+}
+output ack(2 3)
+"""),
+    ("call chain x200", """
+vars(inc counter x)
+set inc to function(n) { return n + 1 }
+set x to 0
+loop counter from 1 to 200 { set x to inc(inc(inc(inc(inc(x))))) }
+output x
+"""),
+]
+
+def doubleEvalCall(self, context):
+    # FunctionCall.eval as it was before arguments were evaluated once
+    fnName = self.identifier.id
+    exprList = self.exprList.exprs
+    exprs = [ ]
+    for expr in exprList:
+        exprs.append(expr.eval(context))
+    fn = self.identifier.eval(context)
+    args = [expr.eval(context) for expr in exprList]
+    result = fn.block.eval(fn.bind(fnName, args, context))
+    if (isinstance(result, simpleLanguage.ReturnValue)):
+        return result.value
+    return result
+
+def benchCalls():
+    print("calls: call-heavy programs on the tree-walking evaluator")
+    FunctionCall = simpleLanguage.FunctionCall
+    for (label, code) in CALL_PROGRAMS:
+        ast = simpleLanguage.parseTopLevelBlock(code)
+        evalOnce = FunctionCall.eval
+        FunctionCall.eval = doubleEvalCall
+        try:
+            baseline = bestTime(lambda: evalQuietly(ast))
+        finally:
+            FunctionCall.eval = evalOnce
+        report(label + ", args evaluated twice", baseline)
+        report(label + ", args evaluated once",
+               bestTime(lambda: evalQuietly(ast)), baseline)
+
+class ReturnStmtException(Exception):
+    def __init__(self, result):
+        self.result = result
+
+def raisingReturn(self, context):
+    # ReturnStmt.eval and FunctionExpr.call as they were when returns
+    # unwound the evaluator with an exception
+    raise ReturnStmtException(self.expr.eval(context))
+
+def catchingCall(self, fnName, args, context):
+    try:
+        return self.block.eval(self.bind(fnName, args, context))
+    except ReturnStmtException as returnStmt:
+        return returnStmt.result
+
+def benchReturns():
+    print("returns: ReturnStmtException vs ReturnValue")
+    ReturnStmt = simpleLanguage.ReturnStmt
+    FunctionExpr = simpleLanguage.FunctionExpr
+    for (label, call) in [("rfib(15)", "rfib(15)"),
+                          ("ifib(30) x500", "ifib(30)")]:
+        code = simpleLanguage.code.replace(
+            "loop counter from 0 to 6 { output rfib(counter) }", "").replace(
+            "loop counter from 0 to 6 { output ifib(counter) }", "")
+        if (call.startswith("ifib")):
+            code += "loop counter from 1 to 500 { output %s }" % call
+        else:
+            code += "output %s" % call
+        ast = simpleLanguage.parseTopLevelBlock(code)
+        saved = (ReturnStmt.eval, FunctionExpr.call)
+        (ReturnStmt.eval, FunctionExpr.call) = (raisingReturn, catchingCall)
+        try:
+            baseline = bestTime(lambda: evalQuietly(ast), 7)
+        finally:
+            (ReturnStmt.eval, FunctionExpr.call) = saved
+        report(label + ", exception", baseline)
+        report(label + ", return value",
+               bestTime(lambda: evalQuietly(ast), 7), baseline)
+
+LOOP_PROGRAM = """
+vars(i j total)
+set total to 0
+loop i from 1 to %d {
+    vars(k)
+    loop j from 1 to 20 {
+        { set k to k + j  set total to total + i * j - k }
+    }
+}
+output total
+"""
+
+def benchResolver(outer=300):
+    code = LOOP_PROGRAM % outer
+    print("resolver: nested loops, %d inner iterations of 8 variable reads" %
+          (outer * 20))
+    def parse(resolve):
+        return simpleLanguage.parseTopLevelBuffer(
+            simpleLanguage.makeTokenBuffer(simpleLanguage.tokenize(code)),
+            resolve)
+    (dynamic, resolved) = (parse(False), parse(True))
+    baseline = bestTime(lambda: evalQuietly(dynamic))
+    report("lookup by name", baseline)
+    report("(depth, slot) addressing", bestTime(lambda: evalQuietly(resolved)),
+           baseline)
+
+def freshFrameLoop(self, context):
+    # LoopStmt.eval as it was before the body's Context was reused
+    identifier = self.identifier
+    fromVal = self.fromExpr.eval(context)
+    toVal = self.toExpr.eval(context)
+    step = +1 if (fromVal<toVal) else -1
+    result = None
+    for varVal in range(fromVal, toVal+step, step): #
+        identifier.assign(context, varVal)
+        result = self.block.eval(context)
+        if (self.canReturn and isinstance(result, simpleLanguage.ReturnValue)):
+            break
+    return result
+
+def countContexts(fn):
+    # number of Contexts made while fn runs, and peak bytes allocated
+    made = [0]
+    Context = simpleLanguage.Context
+    class CountingContext(Context):
+        __slots__ = ()
+        def __init__(self, parent=None, layout=None):
+            made[0] += 1
+            Context.__init__(self, parent, layout)
+    simpleLanguage.Context = CountingContext
+    try:
+        peak = peakMemory(fn)
+    finally:
+        simpleLanguage.Context = Context
+    return (made[0], peak)
+
+def benchFrames(outer=300):
+    code = LOOP_PROGRAM % outer
+    print("frames: nested loops, %d inner iterations" % (outer * 20))
+    def parse(everyBlock):
+        ast = simpleLanguage.parseTopLevelBuffer(
+            simpleLanguage.makeTokenBuffer(simpleLanguage.tokenize(code)),
+            False)
+        if (everyBlock):
+            for node in walkTree(ast):
+                if (isinstance(node, simpleLanguage.BlockStmt)):
+                    node.scoped = True
+        ast.resolve(None)
+        return ast
+    LoopStmt = simpleLanguage.LoopStmt
+    (before, after) = (parse(True), parse(False))
+    reuseFrame = LoopStmt.eval
+    LoopStmt.eval = freshFrameLoop
+    try:
+        baseline = bestTime(lambda: evalQuietly(before))
+        (made, peak) = countContexts(lambda: evalQuietly(before))
+    finally:
+        LoopStmt.eval = reuseFrame
+    report("Context per block run", baseline)
+    print("  %8d Contexts, peak %d KiB" % (made, peak // 1024))
+    report("elided + reused Contexts",
+           bestTime(lambda: evalQuietly(after)), baseline)
+    (made, peak) = countContexts(lambda: evalQuietly(after))
+    print("  %8d Contexts, peak %d KiB" % (made, peak // 1024))
+
+def evalWith(ast, engine):
+    # like evalQuietly, on any of simpleLanguage's engines
+    with contextlib.redirect_stdout(io.StringIO()):
+        return simpleLanguage.evalTopLevel(ast, simpleLanguage.Context(),
+                                           engine)
+
+def enginePrograms():
+    # (label, code) pairs: a tight loop and the call-heavy programs
+    return [("nested loops x300", LOOP_PROGRAM % 300)] + CALL_PROGRAMS
+
+def benchClosures():
+    print("closures: tree-walking eval vs compiled closures")
+    for (label, code) in enginePrograms():
+        ast = simpleLanguage.parseTopLevelBlock(code)
+        baseline = bestTime(lambda: evalWith(ast, "tree"))
+        report(label + ", eval", baseline)
+        report(label + ", closures",
+               bestTime(lambda: evalWith(ast, "closure")), baseline)
+
+def benchVm():
+    print("vm: tree-walking eval vs bytecode")
+    for (label, code) in enginePrograms():
+        ast = simpleLanguage.parseTopLevelBlock(code)
+        baseline = bestTime(lambda: evalWith(ast, "tree"))
+        report(label + ", eval", baseline)
+        report(label + ", bytecode",
+               bestTime(lambda: evalWith(ast, "vm")), baseline)
+
+def runQuietly(program):
+    # run a transpiled program in fresh globals, discarding its output
+    with contextlib.redirect_stdout(io.StringIO()):
+        return program(simpleLanguage.Context())
+
+def benchPython():
+    print("python: tree-walking eval vs transpiled Python")
+    for (label, code) in enginePrograms():
+        ast = simpleLanguage.parseTopLevelBlock(code)
+        baseline = bestTime(lambda: evalWith(ast, "tree"))
+        report(label + ", eval", baseline)
+        report(label + ", transpiled",
+               bestTime(lambda: evalWith(ast, "python")), baseline)
+        program = simpleLanguage.transpile(ast)
+        report(label + ", transpiled, run only",
+               bestTime(lambda: runQuietly(program)), baseline)
+
+FOLDING_PROGRAM = """
+vars(i x y total)
+set total to 0
+loop i from 1 to %d {
+    set x to i * 1 + 0
+    set y to (60 * 60 * 24) - (2 * 3 + 4) * 100
+    set total to total + x * y + 0 * 1 + (42 - 3 - 8 + 4)
+}
+output total
+"""
+
+def benchOptimizer(scale=3000):
+    code = FOLDING_PROGRAM % scale
+    print("optimizer: constant arithmetic and identities, %d iterations" %
+          scale)
+    stats = simpleLanguage.OptimizerStats()
+    plain = simpleLanguage.parseTopLevelBlock(code)
+    optimized = simpleLanguage.parseTopLevelBlock(code, optimize=stats)
+    stats.report()
+    for engine in ["tree", "closure"]:
+        baseline = bestTime(lambda: evalWith(plain, engine))
+        report(engine + ", as parsed", baseline)
+        report(engine + ", optimized",
+               bestTime(lambda: evalWith(optimized, engine)), baseline)
+
+class WrapperNode(simpleLanguage.ParseNode):
+    # a one-operand SumExpr or ProductExpr, as the parser used to put two
+    # of around every literal, variable and call
+    __slots__ = ("expr",)
+    fields = ("expr",)
+    def __init__(self, expr):
+        self.expr = expr
+    def eval(self, context):
+        for i in range(1):
+            result = self.expr.eval(context)
+        return result
+
+def wrapOperands(ast):
+    # the tree as the parser made it before it built binary nodes
+    operands = (simpleLanguage.Literal, simpleLanguage.Identifier,
+                simpleLanguage.FunctionCall)
+    for node in walkTree(ast):
+        for field in node.fields:
+            if (field == "identifier"):
+                continue
+            value = getattr(node, field)
+            if (isinstance(value, tuple)):
+                setattr(node, field, tuple(
+                    WrapperNode(WrapperNode(child))
+                    if isinstance(child, operands) else child
+                    for child in value))
+            elif (isinstance(value, operands)):
+                setattr(node, field, WrapperNode(WrapperNode(value)))
+    return ast
+
+def evalToError(ast):
+    # evalQuietly, stopping quietly at a runtime error too (some samples
+    # end with one on purpose)
+    try:
+        evalQuietly(ast)
+    except Exception:
+        pass
+
+def countEvals(fn):
+    # how many eval methods run while fn does
+    calls = [0]
+    def profile(frame, event, arg):
+        if (event == "call" and frame.f_code.co_name == "eval"):
+            calls[0] += 1
+    sys.setprofile(profile)
+    try:
+        fn()
+    finally:
+        sys.setprofile(None)
+    return calls[0]
+
+def benchWrappers():
+    print("wrappers: sample programs with and without operand wrappers")
+    print("  %-20s %14s %20s" % ("", "nodes", "eval calls"))
+    for (name, code) in simpleLanguage.samplePrograms():
+        wrapped = wrapOperands(simpleLanguage.parseTopLevelBlock(code))
+        ast = simpleLanguage.parseTopLevelBlock(code)
+        counts = [ ]
+        for tree in [wrapped, ast]:
+            counts.append(len(walkTree(tree)))
+            counts.append(countEvals(lambda: evalToError(tree)))
+        print("  %-20s %6d -> %5d %10d -> %7d" %
+              (name, counts[0], counts[2], counts[1], counts[3]))
+
+DEAD_CODE_PROGRAM = """
+vars(x y unused total f i)
+set total to 0
+set x to 2
+set f to function(n) {
+    vars(scratch)
+    if n is 0 then { return 1 }
+    return n
+    output 999
+    set n to n + 1
+}
+loop i from 1 to %d {
+    set x to 2
+    if x is 3 then { output x * 1000 } else { set total to total + x + i }
+    set y to x * 10
+    if y is 20 then { set total to total + f(i) }
+}
+output total
+"""
+
+def benchDeadCode(scale=3000):
+    print("dead code: nodes eliminated by the optimizer")
+    for (name, code) in simpleLanguage.samplePrograms():
+        stats = simpleLanguage.OptimizerStats()
+        simpleLanguage.parseTopLevelBlock(code, optimize=stats)
+        print("  %-20s %4d of %4d nodes" % (name,
+              stats.counts["nodes eliminated"], stats.counts["nodes before"]))
+    code = DEAD_CODE_PROGRAM % scale
+    stats = simpleLanguage.OptimizerStats()
+    plain = simpleLanguage.parseTopLevelBlock(code)
+    optimized = simpleLanguage.parseTopLevelBlock(code, optimize=stats)
+    print("  constant branches, %d iterations:" % scale)
+    stats.report()
+    baseline = bestTime(lambda: evalWith(plain, "tree"))
+    report("as parsed", baseline)
+    report("optimized", bestTime(lambda: evalWith(optimized, "tree")),
+           baseline)
+
+ACCUMULATOR_PROGRAM = """
+vars(sum)
+set sum to function(n acc) {
+    if n is 0 then { return acc }
+    return sum(n - 1 acc + n)
+}
+output sum(%d 0)
+"""
+
+def benchTailCalls(depths=(10000, 100000)):
+    print("tail calls: accumulator recursion on the VM")
+    for depth in depths:
+        ast = simpleLanguage.parseTopLevelBlock(ACCUMULATOR_PROGRAM % depth)
+        try:
+            evalQuietly(ast)
+            tree = "ok"
+        except RecursionError:
+            tree = "RecursionError"
+        seconds = bestTime(lambda: evalWith(ast, "vm"), 1)
+        peak = peakMemory(lambda: evalWith(ast, "vm"))
+        print("  depth %-8d eval: %-16s vm: %8.2f ms, peak %d KiB" %
+              (depth, tree, seconds * 1000, peak // 1024))
+
+RFIB_PROGRAM = """
+vars(rfib)
+set rfib to function(n) {
+    if n is 0 then { return 1 }
+    if n is 1 then { return 1 }
+    return rfib(n-1) + rfib(n-2)
+}
+output rfib(%d)
+"""
+
+def benchMemo(plainN=20, memoN=30):
+    print("memo: rfib with and without memoized pure functions")
+    ast = simpleLanguage.parseTopLevelBlock(RFIB_PROGRAM % plainN)
+    report("rfib(%d), no memo" % plainN, bestTime(lambda: evalQuietly(ast), 1))
+    for n in [plainN, memoN]:
+        def run():
+            ast = simpleLanguage.parseTopLevelBlock(RFIB_PROGRAM % n,
+                                                    memoize=True)
+            evalQuietly(ast)
+            return ast
+        seconds = bestTime(run)
+        cache = simpleLanguage.functionNames(run())["rfib"].memo
+        report("rfib(%d), memoized" % n, seconds)
+        print("    %d hits, %d misses" % (cache.hits, cache.misses))
+
+LOOP_PROGRAMS = [
+    ("counting", """
+vars(i n)
+loop i from 1 to %d { set n to i }
+"""),
+    ("dynamic variable", """
+vars(i f)
+set f to function(n) {
+    vars(last)
+    loop i from 1 to n { set last to i }
+    return last
+}
+output f(%d)
+"""),
+    ("invariant", """
+vars(a b s i)
+set a to 3
+set b to 4
+set s to 0
+loop i from 1 to %d {
+    set s to s + (a * b + a) * (b - a)
+    set s to s - i
+}
+"""),
+    ("accumulator", """
+vars(s i)
+set s to 0
+loop i from 1 to %d { set s to s + 2 * i + 1 }
+output s
+"""),
+]
+
+def benchLoops(scale=20000):
+    print("loops: %d iterations, as parsed and optimized" % scale)
+    for (name, program) in LOOP_PROGRAMS:
+        code = program % scale
+        plain = simpleLanguage.parseTopLevelBlock(code)
+        optimized = simpleLanguage.parseTopLevelBlock(code, optimize=True)
+        print("  %s:" % name)
+        for engine in ("tree", "closure"):
+            baseline = bestTime(lambda: evalWith(plain, engine))
+            report("%s, as parsed" % engine, baseline)
+            report("%s, optimized" % engine,
+                   bestTime(lambda: evalWith(optimized, engine)), baseline)
+
+REDUCTION_PROGRAM = """
+vars(s i square)
+set square to function(x) { return x * x }
+set s to 0
+loop i from 1 to %d { set s to s + square(i) %% 1000 - i %% 7 }
+output s
+"""
+
+def benchReductions(scales=(1000, 10000, 100000)):
+    numpy = simpleLanguage.numpy
+    print("reductions: NumPy %s" %
+          ("not installed" if (numpy == None) else numpy.__version__))
+    for scale in scales:
+        code = REDUCTION_PROGRAM % scale
+        plain = simpleLanguage.parseTopLevelBlock(code)
+        optimized = simpleLanguage.parseTopLevelBlock(code, optimize=True)
+        baseline = bestTime(lambda: evalWith(plain, "tree"), 1)
+        report("%d iterations, as parsed" % scale, baseline)
+        report("%d iterations, optimized" % scale,
+               bestTime(lambda: evalWith(optimized, "tree")), baseline)
+
+DEEP_CALL_PROGRAM = """
+vars(total)
+set total to function(n) {
+    if n is 0 then { return 0 }
+    return n + total(n - 1)
+}
+output total(%d)
+"""
+
+def parseWithCaches(code, caches):
+    # call sites get CallSiteCaches, as the program is resolved, only
+    # while INLINE_CACHES is set
+    saved = simpleLanguage.INLINE_CACHES
+    simpleLanguage.INLINE_CACHES = caches
+    try:
+        return simpleLanguage.parseTopLevelBlock(code)
+    finally:
+        simpleLanguage.INLINE_CACHES = saved
+
+def benchInlineCaches(depth=1500):
+    print("inline caches: call sites with and without CallSiteCaches")
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, 20 * depth))
+    try:
+        programs = CALL_PROGRAMS + [("recursion depth %d" % depth,
+                                     DEEP_CALL_PROGRAM % depth)]
+        for (label, code) in programs:
+            print("  %s:" % label)
+            (plain, cached) = (parseWithCaches(code, False),
+                               parseWithCaches(code, True))
+            for engine in ("tree", "closure"):
+                baseline = bestTime(lambda: evalWith(plain, engine))
+                report("%s, uncached" % engine, baseline)
+                report("%s, cached" % engine,
+                       bestTime(lambda: evalWith(cached, engine)), baseline)
+            simpleLanguage.reportCallSites(cached)
+    finally:
+        sys.setrecursionlimit(limit)
+
+##############################################
+## Driver
+##############################################
+
+BENCHMARKS = [
+    ("lexer", benchLexer),
+    ("lexemes", benchLexemes),
+    ("streaming", benchStreaming),
+    ("mapped", benchMapped),
+    ("compact", benchCompact),
+    ("packrat", benchPackrat),
+    ("predictive", benchPredictive),
+    ("nodes", benchNodeMemory),
+    ("calls", benchCalls),
+    ("returns", benchReturns),
+    ("resolver", benchResolver),
+    ("frames", benchFrames),
+    ("closures", benchClosures),
+    ("vm", benchVm),
+    ("python", benchPython),
+    ("optimizer", benchOptimizer),
+    ("wrappers", benchWrappers),
+    ("deadcode", benchDeadCode),
+    ("tailcalls", benchTailCalls),
+    ("memo", benchMemo),
+    ("loops", benchLoops),
+    ("reductions", benchReductions),
+    ("inline", benchInlineCaches),
+]
+
+if (__name__ == "__main__"):
+    names = sys.argv[1:]
+    for (name, bench) in BENCHMARKS:
+        if (names == [] or name in names):
+            bench()
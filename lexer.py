@@ -7,13 +7,46 @@ COMMENT_START = ";"
 COMMENT_END = "\n"
 EOF = chr(0)
 
+# Every token carries an integer kind, numbered as in simpleLanguage.py.
+# Each keyword and each punctuation character has a kind of its own; all
+# other names are TOKEN_ID, and their values are interned.
+try:
+    from sys import intern
+except ImportError:
+    pass # Python 2, where intern is a builtin
+
+TOKEN_EOF = -1
+TOKEN_INT = 0
+TOKEN_ID = 1
+
+KEYWORDS = ["set", "to", "loop", "from", "if", "is", "then", "else",
+            "vars", "function", "return", "output"]
+PUNCTUATION = "=<>+-*/%(){}"
+
+TOKEN_KINDS = { EOF: TOKEN_EOF }
+for (i, keyword) in enumerate(KEYWORDS):
+    TOKEN_KINDS[keyword] = 100 + i
+for (i, ch) in enumerate(PUNCTUATION):
+    TOKEN_KINDS[ch] = 200 + i
+
+def tokenKind(value):
+    if (type(value) == int):
+        return TOKEN_INT
+    else:
+        return TOKEN_KINDS.get(value, TOKEN_ID)
+
 class Token(object):
-    def __init__(self, value):
+    def __init__(self, value, kind=None):
+        if (kind == None):
+            kind = tokenKind(value)
+        if (kind == TOKEN_ID):
+            value = intern(value)
         self.value = value
+        self.kind = kind
     def __repr__(self):
         return "Token(%r)" % (self.value)
     def eof(self):
-        return self.value == EOF
+        return self.kind == TOKEN_EOF
 
 class Buffer(object):
     def __init__(self, sequence, terminator=EOF):
@@ -40,7 +73,11 @@ class Buffer(object):
     def rewind(self):
         self.next = 0
 
-def tokenize(code):
+def tokenize(code, engine="buffer"):
+    if (engine == "dfa"):
+        return tokenizeDfa(code)
+    elif (engine != "buffer"):
+        raise Exception("Unknown lexer engine: " + str(engine))
     tokens = []
     buffer = Buffer(code)
     while buffer.hasNext():
@@ -53,7 +90,7 @@ def tokenize(code):
             tokens.append(tokenizeId(buffer))
         elif (ch.isspace()):
             buffer.get() # eat the whitespace and continue
-        elif (ch in "=+-*/(){}"):
+        elif (ch in PUNCTUATION):
             tokens.append(Token(buffer.get()))
         else:
             raise Exception("Illegal character: " + str(ch))
@@ -64,17 +101,73 @@ def eatComment(buffer):
         if (buffer.get() in [COMMENT_END, EOF]):
             return
 
-def tokenizeInt(buffer):
+# scan a whole lexeme, then take it out of the source as one slice
+def scanWhile(buffer, test):
+    sequence = buffer.sequence
+    start = end = buffer.next
+    while (end < len(sequence) and test(sequence[end])):
+        end += 1
+    buffer.next = end
+    return sequence[start:end]
+
+# newer Pythons refuse int() on strings longer than 4300 digits, so very
+# long literals are converted a chunk at a time
+INT_CHUNK = 4000
+
+def digitsToInt(digits):
+    if (len(digits) <= INT_CHUNK):
+        return int(digits)
     result = 0
-    while (buffer.peek().isdigit()):
-        result = 10*result + int(buffer.get())
-    return Token(result)
+    for i in range(0, len(digits), INT_CHUNK):
+        chunk = digits[i:i+INT_CHUNK]
+        result = result * 10**len(chunk) + int(chunk)
+    return result
+
+def tokenizeInt(buffer):
+    return Token(digitsToInt(scanWhile(buffer, str.isdigit)))
 
 def tokenizeId(buffer):
-    result = ""
-    while (buffer.peek().isalnum()):
-        result += buffer.get()
-    return Token(result)
+    return Token(scanWhile(buffer, str.isalnum))
+
+# The same regular grammar compiled into one master regex, so the scan
+# runs inside the re automaton instead of through per-character Buffer
+# calls.  Each match skips any run of whitespace and comments, then
+# captures at most one token (only the final match may capture none).
+# As in eatComment, a NUL ends a comment without being consumed.
+import re
+
+DFA_PATTERN = re.compile(r"""
+    (?: \s | ;[^\n\x00]*\n? )*
+    (?: (\d+)                  # 1: int
+      | ([^\W\d_][^\W_]*)      # 2: identifier
+      | ([=<>+\-*/%(){}])      # 3: punctuation
+      | (.)                    # 4: illegal character
+    )?
+    """, re.VERBOSE | re.DOTALL)
+
+# \w also takes in characters that are numeric but not digits (vulgar
+# fractions, superscripts, Roman numerals), and the buffer lexer never
+# starts an identifier with one
+def dfaIdentifier(value):
+    if (not value[0].isalpha()):
+        raise Exception("Illegal character: " + value[0])
+    return value
+
+def tokenizeDfa(code):
+    tokens = []
+    for match in DFA_PATTERN.finditer(code):
+        group = match.lastindex
+        if (group == 1):
+            tokens.append(Token(digitsToInt(match.group(1)), TOKEN_INT))
+        elif (group == 2):
+            value = dfaIdentifier(match.group(2))
+            tokens.append(Token(value, TOKEN_KINDS.get(value, TOKEN_ID)))
+        elif (group == 3):
+            value = match.group(3)
+            tokens.append(Token(value, TOKEN_KINDS[value]))
+        elif (group == 4):
+            raise Exception("Illegal character: " + match.group(4))
+    return tokens
 
 def testLexer():
     code = """
@@ -83,7 +176,7 @@ def testLexer():
     y = 456 + 78
     
     """
-    print tokenize(code)
+    print(tokenize(code))
 
 if (__name__ == "__main__"):
     testLexer()
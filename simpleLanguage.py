@@ -50,15 +50,54 @@ COMMENT_START = ";"
 COMMENT_END = "\n"
 EOF = chr(0)
 
+# Every token carries an integer kind, so the parser can dispatch on int
+# comparisons.  Each keyword and each punctuation character has a kind of
+# its own; all other names are TOKEN_ID, and their values are interned so
+# Context lookups on them hit the identity fast path of dict.
+import sys
+
+TOKEN_EOF = -1
+TOKEN_INT = 0
+TOKEN_ID = 1
+
+KEYWORDS = ["set", "to", "loop", "from", "if", "is", "then", "else",
+            "vars", "function", "return", "output"]
+PUNCTUATION = "=<>+-*/%(){}"
+
+TOKEN_KINDS = { EOF: TOKEN_EOF }
+for (i, keyword) in enumerate(KEYWORDS):
+    TOKEN_KINDS[keyword] = 100 + i
+for (i, ch) in enumerate(PUNCTUATION):
+    TOKEN_KINDS[ch] = 200 + i
+
+(KW_SET, KW_TO, KW_LOOP, KW_FROM, KW_IF, KW_IS, KW_THEN, KW_ELSE,
+ KW_VARS, KW_FUNCTION, KW_RETURN, KW_OUTPUT) = [TOKEN_KINDS[keyword]
+                                               for keyword in KEYWORDS]
+(EQUALS, LESS, GREATER, PLUS, MINUS, TIMES, DIVIDE, PERCENT,
+ LPAREN, RPAREN, LBRACE, RBRACE) = [TOKEN_KINDS[ch] for ch in PUNCTUATION]
+
+def tokenKind(value):
+    if (type(value) == int):
+        return TOKEN_INT
+    else:
+        return TOKEN_KINDS.get(value, TOKEN_ID)
+
 class Token(object):
-    def __init__(self, value):
+    def __init__(self, value, kind=None):
+        if (kind == None):
+            kind = tokenKind(value)
+        if (kind == TOKEN_ID):
+            value = sys.intern(value)
         self.value = value
+        self.kind = kind
     def __repr__(self):
         return "Token(%r)" % (self.value)
     def eof(self):
-        return self.value == EOF
+        return self.kind == TOKEN_EOF
 
 class Buffer(object):
+    memo = None # packrat table for the parser, see packrat()
+    predictive = True # let the parser pick rules by the next token
     def __init__(self, sequence, terminator=EOF):
         self.sequence = sequence
         self.next = 0
@@ -74,6 +113,11 @@ class Buffer(object):
         ch = self.peek()
         if (ch != self.terminator): self.next += 1
         return ch
+    def peekKind(self):
+        # for a buffer of Tokens: the kind of the next one
+        return self.peek().kind
+    def getKind(self):
+        return self.get().kind
     def unget(self):
         if (self.next > 0): self.next -= 1
     def getMark(self):
@@ -82,8 +126,18 @@ class Buffer(object):
         self.next = mark
     def rewind(self):
         self.next = 0
+    def discard(self):
+        # nothing before the current position will be revisited
+        if (self.memo != None):
+            self.memo.clear()
 
-def tokenize(code):
+def tokenize(code, engine="buffer"):
+    if (engine == "dfa"):
+        return tokenizeDfa(code)
+    elif (engine == "compact"):
+        return tokenizeCompact(code)
+    elif (engine != "buffer"):
+        raise Exception("Unknown lexer engine: " + str(engine))
     tokens = []
     buffer = Buffer(code)
     while buffer.hasNext():
@@ -96,7 +150,7 @@ def tokenize(code):
             tokens.append(tokenizeId(buffer))
         elif (ch.isspace()):
             buffer.get() # eat the whitespace and continue
-        elif (ch in "=+-*/(){}"):
+        elif (ch in PUNCTUATION):
             tokens.append(Token(buffer.get()))
         else:
             raise Exception("Illegal character: " + str(ch))
@@ -107,17 +161,307 @@ def eatComment(buffer):
         if (buffer.get() in [COMMENT_END, EOF]):
             return
 
-def tokenizeInt(buffer):
+# scan a whole lexeme, then take it out of the source as one slice
+def scanWhile(buffer, test):
+    sequence = buffer.sequence
+    start = end = buffer.next
+    while (end < len(sequence) and test(sequence[end])):
+        end += 1
+    buffer.next = end
+    return sequence[start:end]
+
+# newer Pythons refuse int() on strings longer than 4300 digits, so very
+# long literals are converted a chunk at a time
+INT_CHUNK = 4000
+
+def digitsToInt(digits):
+    if (len(digits) <= INT_CHUNK):
+        return int(digits)
     result = 0
-    while (buffer.peek().isdigit()):
-        result = 10*result + int(buffer.get())
-    return Token(result)
+    for i in range(0, len(digits), INT_CHUNK):
+        chunk = digits[i:i+INT_CHUNK]
+        result = result * 10**len(chunk) + int(chunk)
+    return result
+
+def tokenizeInt(buffer):
+    return Token(digitsToInt(scanWhile(buffer, str.isdigit)))
 
 def tokenizeId(buffer):
-    result = ""
-    while (buffer.peek().isalnum()):
-        result += buffer.get()
-    return Token(result)
+    return Token(scanWhile(buffer, str.isalnum))
+
+# The same regular grammar compiled into one master regex, so the scan
+# runs inside the re automaton instead of through per-character Buffer
+# calls.  Each match skips any run of whitespace and comments, then
+# captures at most one token (only the final match may capture none).
+# As in eatComment, a NUL ends a comment without being consumed.
+import re
+
+DFA_PATTERN = re.compile(r"""
+    (?: \s | ;[^\n\x00]*\n? )*
+    (?: (\d+)                  # 1: int
+      | ([^\W\d_][^\W_]*)      # 2: identifier
+      | ([=<>+\-*/%(){}])      # 3: punctuation
+      | (.)                    # 4: illegal character
+    )?
+    """, re.VERBOSE | re.DOTALL)
+
+# \w also takes in characters that are numeric but not digits (vulgar
+# fractions, superscripts, Roman numerals), and the buffer lexer never
+# starts an identifier with one
+def dfaIdentifier(value):
+    if (not value[0].isalpha()):
+        raise Exception("Illegal character: " + value[0])
+    return value
+
+def tokenizeDfa(code):
+    tokens = []
+    for match in DFA_PATTERN.finditer(code):
+        group = match.lastindex
+        if (group == 1):
+            tokens.append(Token(digitsToInt(match.group(1)), TOKEN_INT))
+        elif (group == 2):
+            value = dfaIdentifier(match.group(2))
+            tokens.append(Token(value, TOKEN_KINDS.get(value, TOKEN_ID)))
+        elif (group == 3):
+            value = match.group(3)
+            tokens.append(Token(value, TOKEN_KINDS[value]))
+        elif (group == 4):
+            raise Exception("Illegal character: " + match.group(4))
+    return tokens
+
+##############################################
+## Streaming Lexer
+##############################################
+
+# iterTokens lexes a file object (anything with read(), such as the
+# result of socket.makefile()) or an iterable of str/bytes chunks, and
+# yields tokens as soon as they are complete.  Only the unfinished
+# lexeme at the end of a chunk is carried over, and a comment that runs
+# off the end of a chunk is dropped and remembered as a flag, so memory
+# is bounded by the chunk size plus the longest single lexeme.
+
+STREAM_CHUNK = 64 * 1024
+
+import codecs
+
+def iterChunks(stream, chunkSize=STREAM_CHUNK):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = stream
+    if (hasattr(stream, "read")):
+        chunks = iter(lambda: stream.read(chunkSize), stream.read(0))
+    for chunk in chunks:
+        if (not isinstance(chunk, str)):
+            chunk = decoder.decode(chunk)
+        if (chunk):
+            yield chunk
+    tail = decoder.decode(b"", True)
+    if (tail):
+        yield tail
+
+def iterTokens(stream, chunkSize=STREAM_CHUNK):
+    pending = ""
+    inComment = False
+    for chunk in iterChunks(stream, chunkSize):
+        if (inComment):
+            # finish the comment left open by the previous chunk
+            newline = chunk.find(COMMENT_END)
+            nul = chunk.find(EOF)
+            if (newline < 0 and nul < 0):
+                continue
+            elif (nul < 0 or 0 <= newline < nul):
+                chunk = chunk[newline+1:]
+            else:
+                chunk = chunk[nul:]
+            inComment = False
+        text = pending + chunk
+        pending = ""
+        for match in DFA_PATTERN.finditer(text):
+            group = match.lastindex
+            if (match.end() == len(text)):
+                if (group == 1 or group == 2):
+                    # the lexeme may continue in the next chunk
+                    pending = match.group(group)
+                    break
+                elif (group == None):
+                    skipped = text[match.start():]
+                    start = skipped.rfind(COMMENT_START)
+                    inComment = (start >= 0 and
+                                 COMMENT_END not in skipped[start:])
+                    break
+            if (group == 1):
+                yield Token(digitsToInt(match.group(1)), TOKEN_INT)
+            elif (group == 2):
+                yield Token(dfaIdentifier(match.group(2)))
+            elif (group == 3):
+                yield Token(match.group(3))
+            elif (group == 4):
+                raise Exception("Illegal character: " + match.group(4))
+    if (pending):
+        for token in tokenizeDfa(pending):
+            yield token
+
+iter_tokens = iterTokens
+
+##############################################
+## Memory-Mapped Lexer
+##############################################
+
+# iterMappedTokens lexes raw bytes (an mmap, memoryview or bytes) in
+# place, with an ASCII version of DFA_PATTERN: only individual lexemes
+# are ever copied out of the mapping.  Anything non-ASCII outside a
+# comment (or touching an identifier or number) falls back to decoding
+# the rest of the input in STREAM_CHUNK pieces through iterTokens, so
+# the result is always the same token stream that tokenize() produces.
+
+import mmap, os
+
+MAPPED_PATTERN = re.compile(br"""
+    (?: [\s\x1c-\x1f] | ;[^\n\x00]*\n? )*
+    (?: ([0-9]+)                 # 1: int
+      | ([A-Za-z][A-Za-z0-9]*)   # 2: identifier
+      | ([=<>+\-*/%(){}])        # 3: punctuation
+      | (.)                      # 4: illegal character or non-ASCII
+    )?
+    """, re.VERBOSE | re.DOTALL)
+
+def iterMappedTokens(data):
+    size = len(data)
+    for match in MAPPED_PATTERN.finditer(data):
+        group = match.lastindex
+        if (group == None):
+            continue
+        end = match.end()
+        if (data[end-1] >= 0x80 or
+            (group < 3 and end < size and data[end] >= 0x80)):
+            start = match.start(group)
+            chunks = (data[i:i+STREAM_CHUNK]
+                      for i in range(start, size, STREAM_CHUNK))
+            for token in iterTokens(chunks):
+                yield token
+            return
+        elif (group == 1):
+            yield Token(digitsToInt(match.group(1)), TOKEN_INT)
+        elif (group == 4):
+            raise Exception("Illegal character: " + match.group(4).decode())
+        else:
+            yield Token(match.group(group).decode("ascii"))
+
+class StreamBuffer(Buffer):
+    # A Buffer over a lazily consumed iterator.  Items already read stay
+    # in a lookahead window so getMark/setMark can backtrack within it;
+    # discard() drops everything before the current position, and marks
+    # are absolute positions that must not point before the window.
+    def __init__(self, iterable, terminator=EOF):
+        self.iterator = iter(iterable)
+        self.window = []
+        self.base = 0
+        self.next = 0
+        self.terminator = terminator
+    def fill(self):
+        while (self.next - self.base >= len(self.window)):
+            if (self.iterator == None):
+                return False
+            try:
+                self.window.append(next(self.iterator))
+            except StopIteration:
+                self.iterator = None
+                return False
+        return True
+    def hasNext(self):
+        return self.fill()
+    def peek(self):
+        if (self.fill()):
+            return self.window[self.next - self.base]
+        else:
+            return self.terminator
+    def setMark(self, mark):
+        if (mark < self.base):
+            raise Exception("Mark outside the lookahead window: " + str(mark))
+        self.next = mark
+    def rewind(self):
+        self.setMark(0)
+    def discard(self):
+        Buffer.discard(self)
+        del self.window[:self.next - self.base]
+        self.base = self.next
+
+##############################################
+## Compact Token Stream
+##############################################
+
+# A TokenArray holds a token stream as two parallel array('i')s: the
+# token's kind and an index into a table of Token objects with one entry
+# per distinct lexeme.  Indexing it hands back the shared Token, so the
+# Token API is unchanged while each token costs 8 bytes.
+
+from array import array
+
+class TokenArray(object):
+    def __init__(self):
+        self.kinds = array("i")
+        self.indexes = array("i")
+        self.literals = [ ]
+        self.literalIndex = dict()
+    def append(self, value):
+        index = self.literalIndex.get(value)
+        if (index == None):
+            index = len(self.literals)
+            self.literals.append(Token(value))
+            self.literalIndex[value] = index
+        self.kinds.append(self.literals[index].kind)
+        self.indexes.append(index)
+    def __len__(self):
+        return len(self.indexes)
+    def __getitem__(self, i):
+        return self.literals[self.indexes[i]]
+    def __repr__(self):
+        return "TokenArray(%r)" % (list(self))
+
+def tokenizeCompact(code):
+    tokens = TokenArray()
+    for match in DFA_PATTERN.finditer(code):
+        group = match.lastindex
+        if (group == 1):
+            tokens.append(digitsToInt(match.group(1)))
+        elif (group == 2):
+            tokens.append(dfaIdentifier(match.group(2)))
+        elif (group == 3):
+            tokens.append(match.group(3))
+        elif (group == 4):
+            raise Exception("Illegal character: " + match.group(4))
+    return tokens
+
+class CompactBuffer(Buffer):
+    # Buffer over a TokenArray, reading the arrays directly
+    def __init__(self, tokens, terminator=EOF):
+        Buffer.__init__(self, tokens, terminator)
+        self.kinds = tokens.kinds
+        self.indexes = tokens.indexes
+        self.literals = tokens.literals
+    def peek(self):
+        if (self.next < len(self.indexes)):
+            return self.literals[self.indexes[self.next]]
+        else:
+            return self.terminator
+    def get(self):
+        next = self.next
+        if (next < len(self.indexes)):
+            self.next = next + 1
+            return self.literals[self.indexes[next]]
+        else:
+            return self.terminator
+    def peekKind(self):
+        if (self.next < len(self.kinds)):
+            return self.kinds[self.next]
+        else:
+            return TOKEN_EOF
+    def getKind(self):
+        next = self.next
+        if (next < len(self.kinds)):
+            self.next = next + 1
+            return self.kinds[next]
+        else:
+            return TOKEN_EOF
 
 def testLexer():
     code = """
@@ -134,45 +478,208 @@ def testLexer():
 
 EOF_TOKEN = Token(EOF)
 
+# A Context is one frame of variables.  Names the resolver (see Scope)
+# gave a slot live in the slots list, at the index the frame's layout
+# maps them to, and are UNBOUND until their vars statement runs; any
+# other name (REPL globals, unresolved code) lives in the bindings dict.
+# Resolved references index slots directly; the lookups by name below
+# are the dynamic fallback and see both kinds of binding.
+
+UNBOUND = object()
+
 class Context(object):
-    def __init__(self, parent=None):
+    hoisted = None # {HoistedExpr: value} for loops running here, if any
+    def __init__(self, parent=None, layout=None):
         self.bindings = dict()
         self.parent = parent
-    def getContext(self, varname):
+        self.layout = layout
+        if (layout == None):
+            self.slots = None
+        else:
+            self.slots = [UNBOUND] * len(layout)
+    def reset(self):
+        # forget every binding, so a loop can reuse the frame
+        self.bindings.clear()
+        slots = self.slots
+        if (slots != None):
+            for i in range(len(slots)):
+                slots[i] = UNBOUND
+    def find(self, varname):
+        # the context holding varname, and its slot (None for bindings)
         context = self
         while (context != None):
             if (varname in context.bindings):
-                return context
-            else:
-                context = context.parent
+                return (context, None)
+            if (context.layout != None):
+                slot = context.layout.get(varname)
+                if (slot != None and context.slots[slot] is not UNBOUND):
+                    return (context, slot)
+            context = context.parent
         raise Exception("Undefined variable: " + varname)
     def get(self, varname):
-        return self.getContext(varname).bindings[varname]
+        (context, slot) = self.find(varname)
+        if (slot == None):
+            return context.bindings[varname]
+        else:
+            return context.slots[slot]
     def set(self, varname, value):
-        self.getContext(varname).bindings[varname] = value
+        (context, slot) = self.find(varname)
+        if (slot == None):
+            overwritten(context.bindings[varname])
+            context.bindings[varname] = value
+        else:
+            overwritten(context.slots[slot])
+            context.slots[slot] = value
+
+class Scope(object):
+    # The resolver's picture of a Context: the slots it will have, and
+    # which names have been declared so far.  A scope with no parent
+    # stands for the dynamic context chain of a function's caller (or of
+    # whatever a top-level block is evaluated in).
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.layout = dict()
+    def declare(self, varname):
+        if (varname not in self.layout):
+            self.layout[varname] = len(self.layout)
+        return self.layout[varname]
+    def lookup(self, varname):
+        # (depth, slot) of varname, or None if only known at runtime
+        scope = self
+        depth = 0
+        while (scope != None):
+            if (varname in scope.layout):
+                return (depth, scope.layout[varname])
+            scope = scope.parent
+            depth += 1
+        return None
 
 GLOBALS = Context()
 
-class ReturnStmtException(Exception):
-    def __init__(self, result):
-        self.result = result
+# ReturnStmt.eval hands back a ReturnValue instead of raising.  Blocks
+# stop at it and, like ifs and loops, pass it up unchanged until
+# FunctionExpr.call unwraps it.  (At the top level it just ends the
+# program, and topLevelValue unwraps it.)  Only blocks and loops whose
+# canReturn was set at parse time check for it.
+class ReturnValue(object):
+    __slots__ = ("value",)
+    def __init__(self, value):
+        self.value = value
+
+def topLevelValue(result):
+    # a program's (or REPL input's) value, as a call would return it
+    if (isinstance(result, ReturnValue)):
+        return result.value
+    return result
+
+# Packrat parsing: when the token buffer carries a memo table, each
+# decorated parse method remembers its result and end position for every
+# (rule, position) it is tried at, so the parser's backtracking never
+# re-parses the same tokens with the same rule.  The decorator only marks
+# a rule; installPackrat wraps the marked rules while such a buffer is
+# parsed, so that parsing without one pays nothing for it.
+def packrat(parse):
+    parse.packrat = True
+    return parse
+
+def memoizeRule(parse):
+    def memoParse(cls, tokenBuffer, *args, **kwargs):
+        memo = tokenBuffer.memo
+        if (memo == None):
+            return parse(cls, tokenBuffer, *args, **kwargs)
+        key = (cls, tokenBuffer.getMark()) + args
+        if (kwargs):
+            key += tuple(sorted(kwargs.items()))
+        entry = memo.get(key)
+        if (entry == None):
+            result = parse(cls, tokenBuffer, *args, **kwargs)
+            entry = memo[key] = (result, tokenBuffer.getMark())
+        else:
+            tokenBuffer.setMark(entry[1])
+        return entry[0]
+    return memoParse
 
+def installPackrat():
+    # wrap every @packrat rule; returns what removePackrat puts back
+    installed = [ ]
+    classes = [ParseNode]
+    for cls in classes:
+        classes.extend(cls.__subclasses__())
+        for (name, method) in list(cls.__dict__.items()):
+            if (isinstance(method, classmethod) and
+                getattr(method.__func__, "packrat", False)):
+                installed.append((cls, name, method))
+                setattr(cls, name, classmethod(memoizeRule(method.__func__)))
+    return installed
+
+def removePackrat(installed):
+    for (cls, name, method) in installed:
+        setattr(cls, name, method)
+
+# AST nodes use __slots__ and keep their children in named fields (a
+# tuple where the arity varies), listed in "fields" in child order.
 class ParseNode(object):
-    def __init__(self, *children):
-        self.children = list(children)
+    __slots__ = ()
+    fields = ()
+    canReturn = False # can evaluating this produce a ReturnValue?
+    def resolve(self, scope):
+        # give variable references their (depth, slot) coordinates
+        for child in self.getChildren():
+            child.resolve(scope)
+    def optimize(self, stats):
+        # the node to evaluate in place of this one (see optimizeTree);
+        # by default, this node with its children optimized
+        for field in self.fields:
+            value = getattr(self, field)
+            if (isinstance(value, tuple)):
+                setattr(self, field,
+                        tuple(child.optimize(stats) for child in value))
+            elif (value != None):
+                setattr(self, field, value.optimize(stats))
+        return self
+    def toClosure(self):
+        # the closure engine: compile this node, once, into a Python
+        # function of the context that does what eval(context) does
+        raise Exception("Cannot compile " + type(self).__name__)
+    def localSlot(self):
+        # the slot, if this is a variable in the current frame, else -1
+        return -1
+    def emit(self, code):
+        # the bytecode engine: append instructions to code (a CodeObject)
+        # that leave the node's value on the VM's stack
+        raise Exception("Cannot compile " + type(self).__name__)
+    def toPython(self, gen):
+        # the Python engine: the source of a Python expression for this
+        # node, in the function gen (a PythonSource) is writing
+        raise Exception("Cannot transpile " + type(self).__name__)
+    def writePython(self, gen, result=False):
+        # write this statement's Python source to gen; if result, it must
+        # also leave its value in _r (see PythonSource)
+        raise Exception("Cannot transpile " + type(self).__name__)
     def printTree(self, depth=0):
         print ("  "*depth, type(self).__name__)
-        for child in self.children:
-            if (isinstance(child, ParseNode)):
-                child.printTree(depth+1)
-            else:
-                raise Exception("Non-PrintNode: ", child)
-    def getChildren():
-        return []
+        for child in self.getChildren():
+            child.printTree(depth+1)
+    def getChildren(self):
+        children = [ ]
+        for field in self.fields:
+            value = getattr(self, field)
+            if (isinstance(value, tuple)):
+                children.extend(value)
+            elif (value != None):
+                children.append(value)
+        return children
 
 class Stmt(ParseNode):
+    __slots__ = ()
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
+        if (tokenBuffer.predictive):
+            rule = STMT_RULES.get(tokenBuffer.peekKind())
+            if (rule == None):
+                return None
+            return rule.parse(tokenBuffer)
         return (OutputStmt.parse(tokenBuffer) or
                 SetStmt.parse(tokenBuffer) or
                 ReturnStmt.parse(tokenBuffer) or
@@ -182,35 +689,201 @@ class Stmt(ParseNode):
                 LoopStmt.parse(tokenBuffer))
 
 class BlockStmt(Stmt):
-    def eval(self, context=GLOBALS):
+    __slots__ = ("stmts", "canReturn", "scoped", "layout", "topLevel",
+                 "callSites")
+    fields = ("stmts",)
+    def __init__(self, *stmts, topLevel=False):
+        self.stmts = stmts
+        self.canReturn = any(stmt.canReturn for stmt in stmts)
+        # only a vars statement directly in the block can bind a name in
+        # its Context, so blocks without one run in the enclosing Context
+        self.scoped = any(isinstance(stmt, VarsStmt) for stmt in stmts)
+        self.layout = None
+        self.topLevel = topLevel # a whole program (see CallSites)
+        self.callSites = None # the program's, once resolved
+    def resolve(self, scope):
+        if (self.scoped):
+            scope = Scope(scope)
+            self.layout = scope.layout
+        for stmt in self.stmts:
+            stmt.resolve(scope)
+        if (self.topLevel):
+            self.callSites = CallSites(self)
+    def runProgram(self, run, context):
+        # run(context), as a run of the program (see CallSites.start)
+        if (self.callSites == None):
+            # never resolved: its call sites are registered now
+            self.callSites = CallSites(self)
+        sites = self.callSites
+        sites.start(context)
+        try:
+            return run(context)
+        finally:
+            sites.finish()
+    def eval(self, context=GLOBALS, frame=None):
+        if (self.topLevel):
+            return self.runProgram(self.evalStmts, context)
+        return self.evalStmts(context, frame)
+    def evalStmts(self, context, frame=None):
+        # frame: a Context already made for this block (see LoopStmt)
+        if (frame == None):
+            frame = Context(context, self.layout) if self.scoped else context
         result = None
-        blockContext = Context(context)
-        for stmt in self.children:
-            result = stmt.eval(blockContext)
+        if (self.canReturn):
+            for stmt in self.stmts:
+                result = stmt.eval(frame)
+                if (isinstance(result, ReturnValue)):
+                    break
+        else:
+            for stmt in self.stmts:
+                result = stmt.eval(frame)
         return result
+    def toClosure(self):
+        run = self.stmtsClosure()
+        if (self.scoped):
+            (stmts, layout) = (run, self.layout)
+            run = lambda context: stmts(Context(context, layout))
+        if (self.topLevel):
+            (block, program) = (self, run)
+            run = lambda context: block.runProgram(program, context)
+        return run
+    def stmtsClosure(self):
+        # the statements alone, run in whatever frame they are given
+        stmts = tuple(stmt.toClosure() for stmt in self.stmts)
+        if (len(stmts) == 1):
+            return stmts[0]
+        if (self.canReturn):
+            def run(context):
+                result = None
+                for stmt in stmts:
+                    result = stmt(context)
+                    if (isinstance(result, ReturnValue)):
+                        break
+                return result
+        else:
+            def run(context):
+                result = None
+                for stmt in stmts:
+                    result = stmt(context)
+                return result
+        return run
+    def emit(self, code):
+        if (self.scoped):
+            code.emit(OP_ENTER, code.constant(self.layout))
+        self.emitStmts(code)
+        if (self.scoped):
+            code.emit(OP_LEAVE)
+    def emitStmts(self, code):
+        # each statement's value is popped but the last one's
+        if (len(self.stmts) == 0):
+            code.emit(OP_CONST, code.constant(None))
+        for (i, stmt) in enumerate(self.stmts):
+            if (i > 0):
+                code.emit(OP_POP)
+            stmt.emit(code)
+    def optimize(self, stats):
+        # Constant propagation down the block's straight-line code: facts
+        # maps names to the literal they were last set to here.  Other
+        # statements forget what they might set, and a call (scoping is
+        # dynamic) might set anything.
+        facts = dict()
+        declared = set()
+        stmts = [ ]
+        for (i, stmt) in enumerate(self.stmts):
+            last = (i == len(self.stmts) - 1)
+            simple = (isinstance(stmt, (SetStmt, OutputStmt, ReturnStmt)) and
+                      not stmt.expr.containsCall())
+            if (simple and facts):
+                stmt.expr = stmt.expr.propagate(facts, stats)
+            stmt = stmt.optimize(stats)
+            if (isinstance(stmt, IfStmt) and not last):
+                stmt = stmt.prune(facts, stats)
+            if (isinstance(stmt, VarsStmt)):
+                for varname in stmt.idList.ids:
+                    if (varname not in declared):
+                        declared.add(varname)
+                        facts[varname] = 0
+                if (not last):
+                    stmt = stmt.dropUnused(stats)
+            elif (isinstance(stmt, SetStmt) and isinstance(stmt.expr, Literal)):
+                facts[stmt.identifier.id] = stmt.expr.value
+            elif (stmt != None):
+                names = assignedNames(stmt)
+                if (names == None):
+                    facts.clear()
+                for varname in (names or ()):
+                    facts.pop(varname, None)
+            if (stmt != None):
+                stmts.append(stmt)
+            if (isinstance(stmt, ReturnStmt) and not last):
+                # the rest of the block can never run
+                for unreachable in self.stmts[i+1:]:
+                    stats.count("unreachable nodes dropped",
+                                countNodes(unreachable))
+                break
+        return BlockStmt(*stmts, topLevel=self.topLevel)
+    def writePython(self, gen, result=False):
+        if (not self.scoped):
+            self.writeStmts(gen, result)
+            return
+        parent = gen.currentContext()
+        frame = gen.pushFrame(self.layout)
+        if (frame.context != None):
+            gen.line("%s = Context(%s, %s)" %
+                     (frame.context, parent, gen.constant(self.layout)))
+        self.writeStmts(gen, result)
+        gen.popFrame()
+    def writeStmts(self, gen, result):
+        if (len(self.stmts) == 0):
+            gen.line("_r = None" if result else "pass")
+        for (i, stmt) in enumerate(self.stmts):
+            stmt.writePython(gen, result and i == len(self.stmts) - 1)
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer, topLevel=False):
         mark = tokenBuffer.getMark()
-        if (topLevel or tokenBuffer.get().value == "{"):
+        if (topLevel or tokenBuffer.getKind() == LBRACE):
             children = []
             while True:
                 stmt = Stmt.parse(tokenBuffer)
                 if (stmt == None):
                     break
                 children.append(stmt)
-            if (topLevel or tokenBuffer.get().value == "}"):
-                return BlockStmt(*children)
+                if (topLevel):
+                    tokenBuffer.discard()
+            if (topLevel or tokenBuffer.getKind() == RBRACE):
+                return BlockStmt(*children, topLevel=topLevel)
         tokenBuffer.setMark(mark)
         return None
 
 class ReturnStmt(Stmt):
+    __slots__ = ("expr",)
+    fields = ("expr",)
+    canReturn = True
+    def __init__(self, expr):
+        self.expr = expr
     def eval(self, context):
-        result = self.children[0].eval(context)
-        raise ReturnStmtException(result)
+        return ReturnValue(self.expr.eval(context))
+    def toClosure(self):
+        expr = self.expr.toClosure()
+        return lambda context: ReturnValue(expr(context))
+    def emit(self, code):
+        if (code.function and isinstance(self.expr, FunctionCall)):
+            # a tail call: the callee returns straight to our caller
+            self.expr.emit(code, True)
+            return
+        self.expr.emit(code)
+        code.emit(OP_RETURN)
+    def writePython(self, gen, result=False):
+        if (gen.topLevel):
+            gen.line("return ReturnValue(%s)" % self.expr.toPython(gen))
+        else:
+            gen.line("return " + self.expr.toPython(gen))
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
         mark = tokenBuffer.getMark()
-        if (tokenBuffer.get().value == "return"):
+        if (tokenBuffer.getKind() == KW_RETURN):
             expr = Expr.parse(tokenBuffer)
             if (expr != None):
                 return ReturnStmt(expr)
@@ -218,20 +891,40 @@ class ReturnStmt(Stmt):
         return None
 
 class SetStmt(Stmt):
+    __slots__ = ("identifier", "expr")
+    fields = ("identifier", "expr")
+    def __init__(self, identifier, expr):
+        self.identifier = identifier
+        self.expr = expr
     def eval(self, context):
-        varname = self.children[0].id
-        varval = self.children[1].eval(context)
-        context.set(varname, varval)
+        varval = self.expr.eval(context)
+        self.identifier.assign(context, varval)
         return varval
+    def toClosure(self):
+        expr = self.expr.toClosure()
+        assign = self.identifier.assignClosure()
+        def run(context):
+            varval = expr(context)
+            assign(context, varval)
+            return varval
+        return run
+    def emit(self, code):
+        self.expr.emit(code)
+        self.identifier.emitStore(code)
+    def writePython(self, gen, result=False):
+        value = self.expr.toPython(gen)
+        if (result):
+            gen.line("_r = " + value)
+            value = "_r"
+        self.identifier.writeAssign(gen, value)
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
         mark = tokenBuffer.getMark()
-        value = tokenBuffer.get().value
-        if (value == "set"):
+        if (tokenBuffer.getKind() == KW_SET):
             id = Identifier.parse(tokenBuffer)
             if (id != None):
-                value = tokenBuffer.get().value
-                if (value == "to"):
+                if (tokenBuffer.getKind() == KW_TO):
                     expr = Expr.parse(tokenBuffer)
                     if (expr != None):
                         return SetStmt(id, expr)
@@ -239,16 +932,65 @@ class SetStmt(Stmt):
         return None
 
 class VarsStmt(Stmt):
+    __slots__ = ("idList", "slots", "callSites")
+    fields = ("idList",)
+    def __init__(self, idList):
+        self.idList = idList
+        self.slots = None
+        self.callSites = None # its program's, if at the program's top
+    def resolve(self, scope):
+        if (scope != None):
+            self.slots = tuple(scope.declare(varname)
+                               for varname in self.idList.ids)
     def eval(self, context):
-        idList = self.children[0]
-        for varname in idList.ids:
+        if (self.callSites != None):
+            # it may hide a function a call site has cached
+            self.callSites.invalidate()
+        if (self.slots != None):
+            slots = context.slots
+            for slot in self.slots:
+                if (slots[slot] is UNBOUND):
+                    slots[slot] = 0
+            return 0
+        for varname in self.idList.ids:
             if (varname not in context.bindings):
                 context.bindings[varname] = 0
         return 0
+    def toClosure(self):
+        return self.eval
+    def emit(self, code):
+        code.emit(OP_VARS, code.constant(self))
+    def dropUnused(self, stats):
+        # declarations of names no identifier in the program mentions,
+        # so that nothing could ever look them up
+        ids = [varname for varname in self.idList.ids
+               if varname in stats.referenced]
+        if (len(ids) == len(self.idList.ids)):
+            return self
+        stats.count("unused declarations removed",
+                    len(self.idList.ids) - len(ids))
+        if (ids == [ ]):
+            return None
+        return VarsStmt(IdList(ids))
+    def writePython(self, gen, result=False):
+        frame = gen.frames[-1] if (self.slots != None) else None
+        if (frame == None or frame.context != None):
+            gen.line("%s.eval(%s)" % (gen.constant(self),
+                                      gen.currentContext()))
+        else:
+            # a local's vars statements run in order, so only the
+            # first one in the block finds it unbound
+            for slot in self.slots:
+                if (slot not in frame.declared):
+                    frame.declared.add(slot)
+                    gen.line(frame.locals[slot] + " = 0")
+        if (result):
+            gen.line("_r = 0")
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
         mark = tokenBuffer.getMark()
-        if (tokenBuffer.get().value == "vars"):
+        if (tokenBuffer.getKind() == KW_VARS):
             idList = IdList.parse(tokenBuffer)
             if (idList != None):
                 return VarsStmt(idList)
@@ -256,71 +998,343 @@ class VarsStmt(Stmt):
         return None
 
 class IfStmt(Stmt):
+    __slots__ = ("identifier", "expr", "thenBlock", "elseBlock", "canReturn")
+    fields = ("identifier", "expr", "thenBlock", "elseBlock")
+    def __init__(self, identifier, expr, thenBlock, elseBlock=None):
+        self.identifier = identifier
+        self.expr = expr
+        self.thenBlock = thenBlock
+        self.elseBlock = elseBlock
+        self.canReturn = (thenBlock.canReturn or
+                          (elseBlock != None and elseBlock.canReturn))
     def eval(self, context):
-        varname = self.children[0].id
-        varval = context.get(varname)
-        targetval = self.children[1].eval(context)
+        varval = self.identifier.eval(context)
+        targetval = self.expr.eval(context)
         if (varval == targetval):
-            return self.children[2].eval(context)
-        elif (len(self.children) == 3):
+            return self.thenBlock.eval(context)
+        elif (self.elseBlock == None):
             # no else clause
             return 0
         else:
-            return self.children[3].eval(context)
+            return self.elseBlock.eval(context)
+    def toClosure(self):
+        identifier = self.identifier.toClosure()
+        expr = self.expr.toClosure()
+        thenBlock = self.thenBlock.toClosure()
+        if (self.elseBlock == None):
+            elseBlock = lambda context: 0
+        else:
+            elseBlock = self.elseBlock.toClosure()
+        def run(context):
+            if (identifier(context) == expr(context)):
+                return thenBlock(context)
+            return elseBlock(context)
+        return run
+    def emit(self, code):
+        self.identifier.emit(code)
+        self.expr.emit(code)
+        toElse = code.emit(OP_JUMP_IF_NE)
+        self.thenBlock.emit(code)
+        toEnd = code.emit(OP_JUMP)
+        code.patch(toElse)
+        if (self.elseBlock == None):
+            code.emit(OP_CONST, code.constant(0))
+        else:
+            self.elseBlock.emit(code)
+        code.patch(toEnd)
+    def prune(self, facts, stats):
+        # the branch that will run, if facts already tell which; the if
+        # is not its block's last statement, so its value is not used
+        if (self.identifier.id not in facts or
+            not isinstance(self.expr, Literal)):
+            return self
+        stats.count("branches pruned")
+        if (facts[self.identifier.id] == self.expr.value):
+            taken = self.thenBlock
+        else:
+            taken = self.elseBlock
+        stats.count("unreachable nodes dropped", countNodes(self) -
+                    (0 if (taken == None) else countNodes(taken)))
+        return taken
+    def writePython(self, gen, result=False):
+        gen.line("if %s == %s:" % (self.identifier.toPython(gen),
+                                   self.expr.toPython(gen)))
+        gen.indent += 1
+        self.thenBlock.writePython(gen, result)
+        gen.indent -= 1
+        if (self.elseBlock != None or result):
+            gen.line("else:")
+            gen.indent += 1
+            if (self.elseBlock == None):
+                gen.line("_r = 0")
+            else:
+                self.elseBlock.writePython(gen, result)
+            gen.indent -= 1
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
         mark = tokenBuffer.getMark()
-        if (tokenBuffer.get().value == "if"):
+        if (tokenBuffer.getKind() == KW_IF):
             identifier = Identifier.parse(tokenBuffer)
             if (identifier == None):
                 raise Exception("Missing identifier in 'if'")
-            if (tokenBuffer.get().value != "is"):
+            if (tokenBuffer.getKind() != KW_IS):
                 raise Exception("Missing 'is' in 'if'")
             expr = Expr.parse(tokenBuffer)
             if (expr == None):
                 raise Exception("Missing expr in 'if'")
-            if (tokenBuffer.get().value != "then"):
+            if (tokenBuffer.getKind() != KW_THEN):
                 raise Exception("Missing 'then' in 'if'")
             thenBlock = BlockStmt.parse(tokenBuffer)
             if (thenBlock == None):
                 raise Exception("Missing thenBlock in 'if'")
-            if (tokenBuffer.peek().value == "else"):
+            if (tokenBuffer.peekKind() == KW_ELSE):
                 tokenBuffer.get() # eat the "else"
                 elseBlock = BlockStmt.parse(tokenBuffer)
                 if (elseBlock == None):
                     raise Exception("Missing block in 'else'")
                 return IfStmt(identifier, expr, thenBlock, elseBlock)
             else:
-                # no else block, so omit it from children
+                # no else block, so leave it as None
                 return IfStmt(identifier, expr, thenBlock)
         tokenBuffer.setMark(mark)
         return None
 
 class LoopStmt(Stmt):
+    __slots__ = ("identifier", "fromExpr", "toExpr", "block", "canReturn",
+                 "hoisted", "accumulator", "reduction")
+    fields = ("identifier", "fromExpr", "toExpr", "block")
+    def __init__(self, identifier, fromExpr, toExpr, block):
+        self.identifier = identifier
+        self.fromExpr = fromExpr
+        self.toExpr = toExpr
+        self.block = block
+        self.canReturn = block.canReturn
+        self.hoisted = () # the body's HoistedExprs (see optimize)
+        self.accumulator = None # (setStmt, a, b), if closed form
+        self.reduction = None # (setStmt, terms), if vectorizable
     def eval(self, context):
-        varName = self.children[0].id
-        fromVal = self.children[1].eval(context)
-        toVal = self.children[2].eval(context)
+        fromVal = self.fromExpr.eval(context)
+        toVal = self.toExpr.eval(context)
+        # the loop variable's home, found once rather than per iteration
+        (store, key) = self.identifier.home(context)
+        overwritten(store[key])
+        if (self.hoisted):
+            self.resetHoisted(context)
+        if (self.accumulator != None):
+            result = self.accumulate(context, fromVal, toVal)
+            if (result is not UNBOUND):
+                return result
+        if (self.reduction != None and numpy != None):
+            result = self.reduce(context, fromVal, toVal)
+            if (result is not UNBOUND):
+                return result
         step = +1 if (fromVal<toVal) else -1
-        block = self.children[3]
+        block = self.block
+        frame = None
+        if (block.scoped):
+            # one Context for the body, wiped before each iteration
+            frame = Context(context, block.layout)
         result = None
         for varVal in range(fromVal, toVal+step, step): #
-            context.set(varName, varVal)
-            result = block.eval(context)
+            store[key] = varVal
+            if (frame != None):
+                frame.reset()
+            result = block.evalStmts(context, frame)
+            if (self.canReturn and isinstance(result, ReturnValue)):
+                break
         return result
+    def resetHoisted(self, context):
+        # a fresh cache of the hoisted values, in the frame the loop runs
+        # in, so each run of the loop (and of a function) has its own
+        values = context.hoisted
+        if (values == None):
+            values = context.hoisted = dict()
+        for node in self.hoisted:
+            values[node] = UNBOUND
+    def accumulate(self, context, fromVal, toVal):
+        # The whole loop at once, for a body that is one set of the form
+        # acc = acc + a*i + b: the values of a*i + b sum to
+        # a*(from+...+to) + b*n.  Only for ints, where the sum is exact;
+        # otherwise UNBOUND, and the loop runs as usual.
+        (setStmt, a, b) = self.accumulator
+        (store, key) = self.identifier.home(context)
+        (accStore, accKey) = setStmt.identifier.home(context)
+        accVal = accStore[accKey]
+        if (type(fromVal) != int or type(toVal) != int or
+            type(accVal) != int):
+            return UNBOUND
+        n = abs(toVal - fromVal) + 1
+        total = accVal + a * ((fromVal + toVal) * n // 2) + b * n
+        store[key] = toVal
+        accStore[accKey] = total
+        return total
+    def reduce(self, context, fromVal, toVal):
+        # the loop as array operations (see Vectorizer), or UNBOUND
+        (setStmt, terms) = self.reduction
+        if (type(fromVal) != int or type(toVal) != int):
+            return UNBOUND
+        n = abs(toVal - fromVal) + 1
+        (lo, hi) = (min(fromVal, toVal), max(fromVal, toVal))
+        if (n < VECTOR_MIN or lo < -INT64_MAX or hi > INT64_MAX):
+            return UNBOUND
+        (store, key) = self.identifier.home(context)
+        (accStore, accKey) = setStmt.identifier.home(context)
+        total = accStore[accKey]
+        if (type(total) != int):
+            return UNBOUND
+        (varname, acc) = (self.identifier.id, setStmt.identifier.id)
+        # Bound every term over all the loop's values before making any
+        # array, the loop variable standing in as the int lo.  A chunk's
+        # sum of a term must fit in an int64 too, which caps the chunk.
+        bounds = Vectorizer(context, varname, (lo, lo, hi), acc)
+        largest = 1
+        for (sign, term) in terms:
+            value = bounds.value(term)
+            if (value == None):
+                return UNBOUND
+            (x, termLo, termHi) = value
+            if (termLo != termHi):
+                largest = max(largest, -termLo, termHi)
+        chunk = min(VECTOR_CHUNK, INT64_MAX // largest)
+        if (chunk < VECTOR_MIN):
+            return UNBOUND
+        try:
+            for start in range(lo, hi + 1, chunk):
+                end = min(start + chunk, hi + 1)
+                values = (numpy.arange(start, end, dtype=numpy.int64),
+                          start, end - 1)
+                vectorizer = Vectorizer(context, varname, values, acc)
+                for (sign, term) in terms:
+                    termSum = vectorizer.sum(end - start, term)
+                    if (termSum == None):
+                        return UNBOUND
+                    total += sign * termSum
+        except MemoryError:
+            return UNBOUND
+        store[key] = toVal
+        accStore[accKey] = total
+        return total
+    def optimize(self, stats):
+        ParseNode.optimize(self, stats)
+        varname = self.identifier.id
+        stmts = self.block.stmts
+        if (len(stmts) == 1 and isinstance(stmts[0], SetStmt)):
+            self.accumulator = accumulatorOf(stmts[0], varname)
+            if (self.accumulator != None):
+                stats.count("accumulators closed")
+                return self
+            self.reduction = reductionOf(stmts[0], varname)
+            if (self.reduction != None):
+                stats.count("reductions found")
+                return self
+        changing = assignedNames(self.block)
+        if (changing != None):
+            # no calls, so only the body's own sets and vars (and the
+            # loop) change what a name in it means
+            changing.add(varname)
+            changing.update(declaredNames(self.block))
+            hoisted = [ ]
+            hoistInvariants(self.block, changing, hoisted)
+            self.hoisted = tuple(hoisted)
+            stats.count("invariants hoisted", len(hoisted))
+        return self
+    def toClosure(self):
+        home = self.identifier.home
+        fromExpr = self.fromExpr.toClosure()
+        toExpr = self.toExpr.toClosure()
+        block = self.block.stmtsClosure()
+        (scoped, layout) = (self.block.scoped, self.block.layout)
+        canReturn = self.canReturn
+        (hoisted, accumulator) = (self.hoisted, self.accumulator)
+        reduction = self.reduction if (numpy != None) else None
+        (accumulate, reduce) = (self.accumulate, self.reduce)
+        resetHoisted = self.resetHoisted
+        def run(context):
+            fromVal = fromExpr(context)
+            toVal = toExpr(context)
+            (store, key) = home(context)
+            overwritten(store[key])
+            if (hoisted):
+                resetHoisted(context)
+            if (accumulator != None):
+                result = accumulate(context, fromVal, toVal)
+                if (result is not UNBOUND):
+                    return result
+            if (reduction != None):
+                result = reduce(context, fromVal, toVal)
+                if (result is not UNBOUND):
+                    return result
+            step = +1 if (fromVal<toVal) else -1
+            frame = context
+            if (scoped):
+                frame = Context(context, layout)
+            result = None
+            for varVal in range(fromVal, toVal+step, step):
+                store[key] = varVal
+                if (scoped):
+                    frame.reset()
+                result = block(frame)
+                if (canReturn and isinstance(result, ReturnValue)):
+                    break
+            return result
+        return run
+    def emit(self, code):
+        # the stack holds the loop's result so far and the range iterator
+        self.fromExpr.emit(code)
+        self.toExpr.emit(code)
+        code.emit(OP_RANGE)
+        top = code.emit(OP_FOR_ITER)
+        self.identifier.emitStore(code)
+        code.emit(OP_POP)
+        self.block.emit(code)
+        code.emit(OP_LOOP_BACK, top) # keep the body's value, then loop
+        code.patch(top)
+    def writePython(self, gen, result=False):
+        (fromVal, toVal, step, varVal) = (gen.temp("from"), gen.temp("to"),
+                                          gen.temp("step"), gen.temp("i"))
+        gen.line("%s = %s" % (fromVal, self.fromExpr.toPython(gen)))
+        gen.line("%s = %s" % (toVal, self.toExpr.toPython(gen)))
+        gen.line("%s = +1 if (%s<%s) else -1" % (step, fromVal, toVal))
+        if (result):
+            gen.line("_r = None")
+        if (self.identifier.pythonInSlot(gen)):
+            # as in eval, only the value before the loop can be a function
+            gen.line("overwritten(%s)" % self.identifier.toPython(gen))
+        assign = self.identifier.pythonAssign(gen, varVal)
+        block = self.block
+        frame = None
+        if (block.scoped):
+            # one frame for the body, made fresh before each iteration
+            parent = gen.currentContext()
+            frame = gen.pushFrame(block.layout)
+            if (frame.context != None):
+                gen.line("%s = Context(%s, %s)" %
+                         (frame.context, parent, gen.constant(block.layout)))
+        gen.line("for %s in range(%s, %s+%s, %s):" %
+                 (varVal, fromVal, toVal, step, step))
+        gen.indent += 1
+        gen.line(assign)
+        if (frame != None and frame.context != None):
+            gen.line(frame.context + ".reset()")
+        block.writeStmts(gen, result)
+        gen.indent -= 1
+        if (frame != None):
+            gen.popFrame()
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
         mark = tokenBuffer.getMark()
-        if (tokenBuffer.get().value == "loop"):
+        if (tokenBuffer.getKind() == KW_LOOP):
             identifier = Identifier.parse(tokenBuffer)
             if (identifier == None):
                 raise Exception("Missing identifier in 'loop'")
-            if (tokenBuffer.get().value != "from"):
+            if (tokenBuffer.getKind() != KW_FROM):
                 raise Exception("Missing 'from' in 'loop'")
             fromExpr = Expr.parse(tokenBuffer)
             if (fromExpr == None):
                 raise Exception("Missing fromExpr in 'loop'")
-            if (tokenBuffer.get().value != "to"):
+            if (tokenBuffer.getKind() != KW_TO):
                 raise Exception("Missing 'to' in 'loop'")
             toExpr = Expr.parse(tokenBuffer)
             if (toExpr == None):
@@ -333,12 +1347,17 @@ class LoopStmt(Stmt):
         return None
 
 class ExprList(ParseNode):
+    __slots__ = ("exprs",)
+    fields = ("exprs",)
+    def __init__(self, *exprs):
+        self.exprs = exprs
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
         mark = tokenBuffer.getMark()
-        if (tokenBuffer.get().value == "("):
+        if (tokenBuffer.getKind() == LPAREN):
             exprs = [ ]
-            while tokenBuffer.peek().value != ")":
+            while tokenBuffer.peekKind() != RPAREN:
                 expr = Expr.parse(tokenBuffer)
                 if (expr == None):
                     raise Exception("Syntax error in ExprList")
@@ -349,16 +1368,18 @@ class ExprList(ParseNode):
         return None
 
 class IdList(ParseNode):
+    __slots__ = ("ids",)
     def __init__(self, ids):
-        self.ids = ids
+        self.ids = tuple(ids)
     def printTree(self, depth=0):
         print("  "*depth, type(self).__name__, "ids=", self.ids)
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
         mark = tokenBuffer.getMark()
-        if (tokenBuffer.get().value == "("):
+        if (tokenBuffer.getKind() == LPAREN):
             ids = [ ]
-            while tokenBuffer.peek().value != ")":
+            while tokenBuffer.peekKind() != RPAREN:
                 identifier = Identifier.parse(tokenBuffer)
                 if (identifier == None):
                     raise Exception("Syntax error in IdList")
@@ -369,16 +1390,35 @@ class IdList(ParseNode):
         return None
 
 class OutputStmt(Stmt):
+    __slots__ = ("expr",)
+    fields = ("expr",)
+    def __init__(self, expr):
+        self.expr = expr
     def eval(self, context):
-        expr = self.children[0]
-        result = expr.eval(context)
+        result = self.expr.eval(context)
         print(result)
         return result
+    def toClosure(self):
+        expr = self.expr.toClosure()
+        def run(context):
+            result = expr(context)
+            print(result)
+            return result
+        return run
+    def emit(self, code):
+        self.expr.emit(code)
+        code.emit(OP_OUTPUT)
+    def writePython(self, gen, result=False):
+        if (result):
+            gen.line("_r = " + self.expr.toPython(gen))
+            gen.line("print(_r)")
+        else:
+            gen.line("print(%s)" % self.expr.toPython(gen))
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
         mark = tokenBuffer.getMark()
-        value = tokenBuffer.get().value
-        if (value == "output"):
+        if (tokenBuffer.getKind() == KW_OUTPUT):
             expr = Expr.parse(tokenBuffer)
             if (expr != None):
                 return OutputStmt(expr)
@@ -386,18 +1426,129 @@ class OutputStmt(Stmt):
         return None
 
 class Expr(Stmt):
+    __slots__ = ()
+    def propagate(self, facts, stats):
+        # this expression with the variables facts knows replaced by
+        # their values
+        return self
+    def isNumeric(self):
+        # whether the value is known to be a number without running it
+        return False
+    def containsCall(self):
+        return False
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
+        if (tokenBuffer.predictive):
+            if (tokenBuffer.peekKind() == KW_FUNCTION):
+                return FunctionExpr.parse(tokenBuffer)
+            return BinaryExpr.parse(tokenBuffer)
         return (FunctionExpr.parse(tokenBuffer) or
-                SumExpr.parse(tokenBuffer))
+                BinaryExpr.parse(tokenBuffer))
 
 class FunctionExpr(Expr):
+    __slots__ = ("idList", "block", "layout", "code", "bytecode", "native",
+                 "memo", "dynamicNames", "callSites")
+    fields = ("idList", "block")
+    def __init__(self, idList, block):
+        self.idList = idList
+        self.block = block
+        self.layout = None
+        self.code = None # the body's closure, once compiled
+        self.bytecode = None # and its CodeObject
+        self.native = None # and its transpiled Python function
+        self.memo = None # a MemoCache, if it is pure (see memoizePure)
+        self.dynamicNames = None # its program's, once compiled
+        self.callSites = None # its program's (see CallSites)
+    def resolve(self, scope):
+        # the body sees its parameters, then the caller's context
+        paramScope = Scope()
+        for varname in self.idList.ids:
+            paramScope.declare(varname)
+        self.layout = paramScope.layout
+        self.block.resolve(paramScope)
     def eval(self, context):
         return self
+    def bind(self, fnName, args, context):
+        # the frame holding the parameters, a child of the caller's context
+        idList = self.idList.ids
+        if (len(idList) != len(args)):
+            raise Exception("Wrong # of arguments: " + fnName)
+        fnContext = Context(context, self.layout)
+        if (self.layout == None):
+            for i in range(len(idList)):
+                fnContext.bindings[idList[i]] = args[i]
+        elif (len(self.layout) == len(args)):
+            fnContext.slots = args
+        else:
+            # a repeated parameter name: the last argument wins
+            for i in range(len(idList)):
+                fnContext.slots[self.layout[idList[i]]] = args[i]
+        return fnContext
+    def call(self, fnName, args, context):
+        # args are already evaluated, each exactly once, in the caller's
+        # context; the function body runs in a child of that context
+        memo = self.memo
+        if (memo != None):
+            key = memoKey(args)
+            result = memo.lookup(key)
+            if (result is not UNBOUND):
+                return result
+        result = self.block.evalStmts(self.bind(fnName, args, context))
+        if (isinstance(result, ReturnValue)):
+            result = result.value
+        if (memo != None):
+            memo.store(key, result)
+        return result
+    def toClosure(self):
+        # the function value is still this node, as it is for eval
+        if (self.code == None):
+            self.code = self.block.toClosure()
+        return lambda context: self
+    def emit(self, code):
+        code.emit(OP_CONST, code.constant(self))
+    def describe(self):
+        return "function(" + " ".join(self.idList.ids) + ")"
+    def toPython(self, gen):
+        gen.functions.append(self)
+        return gen.constant(self)
+    def writePythonDef(self, gen, name):
+        # def name(caller, args), taking args already counted
+        gen.line("def %s(caller, args):" % name)
+        gen.indent += 1
+        frame = gen.pushFrame(self.layout)
+        ids = self.idList.ids
+        if (frame.context == None):
+            targets = [frame.locals[self.layout[varname]] for varname in ids]
+            if (len(targets) > 0):
+                gen.line("(%s,) = args" % ", ".join(targets))
+        else:
+            gen.line("%s = Context(caller, %s)" %
+                     (frame.context, gen.constant(self.layout)))
+            for (i, varname) in enumerate(ids):
+                if (self.layout == None):
+                    gen.line("%s.bindings[%r] = args[%d]" %
+                             (frame.context, varname, i))
+                else:
+                    gen.line("%s.slots[%d] = args[%d]" %
+                             (frame.context, self.layout[varname], i))
+        self.block.writePython(gen, True)
+        gen.line("return _r")
+        gen.popFrame()
+        gen.indent -= 1
+    def toBytecode(self):
+        # the body's CodeObject, compiled on the first call
+        if (self.bytecode == None):
+            self.bytecode = CodeObject(self.describe(), True)
+            self.block.emit(self.bytecode)
+            self.bytecode.emit(OP_RETURN)
+            self.bytecode.finish()
+        return self.bytecode
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
         mark = tokenBuffer.getMark()
-        if (tokenBuffer.get().value == "function"):
+        if (tokenBuffer.getKind() == KW_FUNCTION):
             idList = IdList.parse(tokenBuffer)
             if (idList == None):
                 raise Exception("Missing idList in function")
@@ -408,130 +1559,254 @@ class FunctionExpr(Expr):
         tokenBuffer.setMark(mark)
         return None
 
-class SumExpr(Expr):
+import operator
+
+# Binary operators are parsed by precedence climbing into two-operand
+# nodes that hold the operator's function, resolved once at parse time.
+# New operators only need an OPERATORS entry (and a lexer character).
+
+def compareEqual(a, b): return int(a == b)
+def compareLess(a, b): return int(a < b)
+def compareGreater(a, b): return int(a > b)
+
+class BinaryExpr(Expr):
+    __slots__ = ("op", "fn", "left", "right")
+    fields = ("left", "right")
+    def __init__(self, op, left, right):
+        self.op = op
+        self.fn = OPERATORS[op][2]
+        self.left = left
+        self.right = right
+    def printTree(self, depth=0):
+        print ("  "*depth, type(self).__name__, "op=", self.op)
+        self.left.printTree(depth+1)
+        self.right.printTree(depth+1)
     def eval(self, context):
-        result = self.children[0].eval(context)
-        for i in range(1, len(self.children), 2):
-            op = self.children[i].op
-            arg = self.children[i+1].eval(context)
-            if (op == "+"):
-                result += arg
-            elif (op == "-"):
-                result -= arg
-            else:
-                raise Exception("Unknown op:" + str(op))
-        return result
+        return self.fn(self.left.eval(context), self.right.eval(context))
+    def propagate(self, facts, stats):
+        self.left = self.left.propagate(facts, stats)
+        self.right = self.right.propagate(facts, stats)
+        return self
+    def containsCall(self):
+        return self.left.containsCall() or self.right.containsCall()
+    def isNumeric(self):
+        # arithmetic and comparisons only ever produce numbers
+        return True
+    def optimize(self, stats):
+        ParseNode.optimize(self, stats)
+        (left, right) = (self.left, self.right)
+        if (isinstance(left, Literal) and isinstance(right, Literal)):
+            try:
+                value = self.fn(left.value, right.value)
+            except ZeroDivisionError:
+                # leave it to fail at runtime, if it is ever evaluated
+                return self
+            stats.count("constants folded")
+            return Literal(value)
+        # x+0, 0+x, x-0, x*1 and 1*x are x.  The literal must be an int:
+        # x+0.0 would turn an int x into a float.  And x must be a number:
+        # if it held a function, the arithmetic would have failed.
+        for (literal, other, identity) in [(right, left, "+-*"),
+                                           (left, right, "+*")]:
+            if (self.op in identity and isinstance(literal, Literal) and
+                type(literal.value) == int and other.isNumeric() and
+                literal.value == (1 if (self.op == "*") else 0)):
+                stats.count("identities applied")
+                return other
+        return self
+    def toClosure(self):
+        fn = self.fn
+        # leaves that need no call of their own: a frame-local variable
+        # or a literal
+        (a, b) = (self.left.localSlot(), self.right.localSlot())
+        if (a >= 0 and isinstance(self.right, Literal)):
+            k = self.right.value
+            return lambda context: fn(context.slots[a], k)
+        elif (a >= 0 and b >= 0):
+            return lambda context: fn(context.slots[a], context.slots[b])
+        (left, right) = (self.left.toClosure(), self.right.toClosure())
+        if (isinstance(self.right, Literal)):
+            k = self.right.value
+            return lambda context: fn(left(context), k)
+        elif (self.op == "+"):
+            return lambda context: left(context) + right(context)
+        elif (self.op == "-"):
+            return lambda context: left(context) - right(context)
+        elif (self.op == "*"):
+            return lambda context: left(context) * right(context)
+        return lambda context: fn(left(context), right(context))
+    def emit(self, code):
+        self.left.emit(code)
+        self.right.emit(code)
+        code.emit(BINARY_OPCODES[self.op])
+    def toPython(self, gen):
+        (left, right) = (self.left.toPython(gen), self.right.toPython(gen))
+        if (self.op in "=<>"):
+            op = "==" if (self.op == "=") else self.op
+            return "(1 if %s %s %s else 0)" % (left, op, right)
+        return "(%s %s %s)" % (left, self.op, right)
     @classmethod
-    def parse(cls, tokenBuffer):
-        mark = tokenBuffer.getMark()
-        expr = ProductExpr.parse(tokenBuffer)
-        if (expr == None):
-            tokenBuffer.setMark(mark)
+    @packrat
+    def parse(cls, tokenBuffer, minPrecedence=0):
+        left = SimpleExpr.parse(tokenBuffer)
+        if (left == None):
             return None
-        children = [expr]
         while True:
-            mark = tokenBuffer.getMark()
-            op = SumOperator.parse(tokenBuffer)
-            if (op == None):
+            entry = OPERATOR_KINDS.get(tokenBuffer.peekKind())
+            if (entry == None):
                 break
-            expr = ProductExpr.parse(tokenBuffer)
-            if (expr == None):
+            (op, precedence, nodeClass) = entry
+            if (precedence < minPrecedence):
                 break
-            children += [op, expr]
-        tokenBuffer.setMark(mark)
-        return SumExpr(*children)
-
-class ProductExpr(Expr):
-    def eval(self, context):
-        result = self.children[0].eval(context)
-        for i in range(1, len(self.children), 2):
-            op = self.children[i].op
-            arg = self.children[i+1].eval(context)
-            if (op == "*"):
-                result *= arg
-            elif (op == "/"):
-                result /= arg
-            elif (op == "%"):
-                result %= arg
-            else:
-                raise Exception("Unknown op:" + str(op))
-        return result
-    @classmethod
-    def parse(cls, tokenBuffer):
-        mark = tokenBuffer.getMark()
-        expr = SimpleExpr.parse(tokenBuffer)
-        if (expr == None):
-            tokenBuffer.setMark(mark)
-            return None
-        children = [expr]
-        while True:
             mark = tokenBuffer.getMark()
-            op = ProductOperator.parse(tokenBuffer)
-            if (op == None):
+            tokenBuffer.getKind()
+            right = BinaryExpr.parse(tokenBuffer, precedence + 1)
+            if (right == None):
+                tokenBuffer.setMark(mark)
                 break
-            expr = SimpleExpr.parse(tokenBuffer)
-            if (expr == None):
-                break
-            children += [op, expr]
-        tokenBuffer.setMark(mark)
-        return ProductExpr(*children)
+            left = nodeClass(op, left, right)
+        return left
 
-class Operator(ParseNode):
-    def __init__(self, op):
-        self.op = op
-    def printTree(self, depth=0):
-        print ("  "*depth, type(self).__name__, "op=", self.op)
-    def eval(self, context):
-        return self.value
-    @classmethod
-    def parse(cls, tokenBuffer):
-        mark = tokenBuffer.getMark()
-        value = tokenBuffer.get().value
-        if (type(value) == str) and (value in cls.getOps()):
-            return Operator(value)
-        tokenBuffer.setMark(mark)
-        return None
+class CompareExpr(BinaryExpr):
+    __slots__ = ()
 
-class SumOperator(Operator):
-    @classmethod
-    def getOps(cls): return "+-"
+class SumExpr(BinaryExpr):
+    __slots__ = ()
 
-class ProductOperator(Operator):
-    @classmethod
-    def getOps(cls): return "*/%"
+class ProductExpr(BinaryExpr):
+    __slots__ = ()
+
+# operator -> (precedence, node class, function)
+OPERATORS = {
+    "=": (1, CompareExpr, compareEqual),
+    "<": (1, CompareExpr, compareLess),
+    ">": (1, CompareExpr, compareGreater),
+    "+": (2, SumExpr, operator.add),
+    "-": (2, SumExpr, operator.sub),
+    "*": (3, ProductExpr, operator.mul),
+    "/": (3, ProductExpr, operator.truediv),
+    "%": (3, ProductExpr, operator.mod),
+}
+
+# operator's token kind -> (operator, precedence, node class)
+OPERATOR_KINDS = dict((TOKEN_KINDS[op], (op, precedence, nodeClass))
+                      for (op, (precedence, nodeClass, fn))
+                      in OPERATORS.items())
 
 class SimpleExpr(Expr):
-    # a literal or a variable
+    # a literal, a variable, a call or a parenthesized expression
+    __slots__ = ()
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
+        if (tokenBuffer.predictive):
+            kind = tokenBuffer.peekKind()
+            if (kind == TOKEN_INT):
+                return Literal.parse(tokenBuffer)
+            elif (kind == LPAREN):
+                return cls.parseGroup(tokenBuffer)
+            elif (kind != TOKEN_ID):
+                return None
+            identifier = Identifier.parse(tokenBuffer)
+            if (tokenBuffer.peekKind() != LPAREN):
+                return identifier
+            return FunctionCall(identifier, ExprList.parse(tokenBuffer))
         return (Literal.parse(tokenBuffer) or
                 FunctionCall.parse(tokenBuffer) or
-                Identifier.parse(tokenBuffer))
+                Identifier.parse(tokenBuffer) or
+                cls.parseGroup(tokenBuffer))
+    @classmethod
+    @packrat
+    def parseGroup(cls, tokenBuffer):
+        # the parentheses only steer the parse; no node is made for them
+        mark = tokenBuffer.getMark()
+        if (tokenBuffer.getKind() == LPAREN):
+            expr = Expr.parse(tokenBuffer)
+            if (expr == None):
+                raise Exception("Missing expr in '('")
+            if (tokenBuffer.getKind() != RPAREN):
+                raise Exception("Missing ')'")
+            return expr
+        tokenBuffer.setMark(mark)
+        return None
 
 class FunctionCall(SimpleExpr):
+    __slots__ = ("identifier", "exprList", "cache")
+    fields = ("identifier", "exprList")
+    def __init__(self, identifier, exprList):
+        self.identifier = identifier
+        self.exprList = exprList
+        self.cache = None # a CallSiteCache (see CallSites)
     def eval(self, context):
-        fnName = self.children[0].id
-        exprList = self.children[1].children
-        exprs = [ ]
-        for expr in exprList:
-            exprs.append(expr.eval(context))
-        fn = context.get(fnName)
+        fnName = self.identifier.id
+        args = [expr.eval(context) for expr in self.exprList.exprs]
+        cache = self.cache
+        if (cache != None and cache.version == cache.sites.group.version):
+            cache.hits += 1
+            return cache.fn.call(fnName, args, context)
+        fn = self.identifier.eval(context)
         if (not isinstance(fn, FunctionExpr)):
             raise Exception("Not a function: " + fnName)
-        idList = fn.children[0].ids
-        block = fn.children[1]
-        if (len(idList) != len(exprList)):
-            raise Exception("Wrong # of arguments: " + fnName)
-        fnContext = Context(context)
-        for i in range(len(idList)):
-            varname = idList[i]
-            varvalue = exprList[i].eval(context)
-            fnContext.bindings[varname] = varvalue
-        try:
-            return block.eval(fnContext)
-        except ReturnStmtException as returnStmt:
-            return returnStmt.result
+        # only a name looked up through the context chain is worth
+        # caching, and only one no frame on the way could bind
+        if (cache != None and self.identifier.depth < 0 and
+            fnName not in cache.sites.group.shadowing):
+            cache.fill(fn)
+        return fn.call(fnName, args, context)
+    def toClosure(self):
+        fnName = self.identifier.id
+        exprs = tuple(expr.toClosure() for expr in self.exprList.exprs)
+        lookup = self.identifier.toClosure()
+        cache = self.cache
+        cached = (cache != None and self.identifier.depth < 0)
+        sites = cache.sites if cached else None
+        def run(context):
+            args = [expr(context) for expr in exprs]
+            if (cached and cache.version == sites.group.version):
+                cache.hits += 1
+                fn = cache.fn
+            else:
+                fn = lookup(context)
+                if (not isinstance(fn, FunctionExpr)):
+                    raise Exception("Not a function: " + fnName)
+                if (cached and fnName not in sites.group.shadowing):
+                    cache.fill(fn)
+            code = fn.code
+            if (code == None):
+                # a function value made by eval, not yet compiled
+                code = fn.code = fn.block.toClosure()
+            memo = fn.memo
+            if (memo != None):
+                key = memoKey(args)
+                result = memo.lookup(key)
+                if (result is not UNBOUND):
+                    return result
+            result = code(fn.bind(fnName, args, context))
+            if (isinstance(result, ReturnValue)):
+                result = result.value
+            if (memo != None):
+                memo.store(key, result)
+            return result
+        return run
+    def emit(self, code, tail=False):
+        exprs = self.exprList.exprs
+        for expr in exprs:
+            expr.emit(code)
+        self.identifier.emit(code)
+        code.emit(OP_TAIL_CALL if tail else OP_CALL,
+                  code.constant((self.identifier.id, len(exprs))))
+    def containsCall(self):
+        return True
+    def toPython(self, gen):
+        # Python evaluates callNative's arguments in order, so the
+        # language's arguments still come before the function's lookup
+        args = "".join(expr.toPython(gen) + ", "
+                       for expr in self.exprList.exprs)
+        return "callNative(%r, %s, (%s), %s)" % (
+            self.identifier.id, gen.currentContext(), args,
+            self.identifier.toPython(gen))
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
         mark = tokenBuffer.getMark()
         identifier = Identifier.parse(tokenBuffer)
@@ -543,48 +1818,1339 @@ class FunctionCall(SimpleExpr):
         return None
 
 class Identifier(SimpleExpr):
+    __slots__ = ("id", "depth", "slot")
     def __init__(self, id):
         self.id = id
+        self.depth = -1 # not resolved: look it up by name
+        self.slot = -1
     def printTree(self, depth=0):
         print ("  "*depth, type(self).__name__, "id=", self.id)
+    def resolve(self, scope):
+        if (scope != None):
+            address = scope.lookup(self.id)
+            if (address != None):
+                (self.depth, self.slot) = address
     def eval(self, context):
-        return context.get(self.id)
+        depth = self.depth
+        if (depth < 0):
+            return context.get(self.id)
+        while (depth > 0):
+            context = context.parent
+            depth -= 1
+        return context.slots[self.slot]
+    def assign(self, context, value):
+        depth = self.depth
+        if (depth < 0):
+            context.set(self.id, value)
+            return
+        while (depth > 0):
+            context = context.parent
+            depth -= 1
+        slots = context.slots
+        if (isinstance(slots[self.slot], FunctionExpr)):
+            overwritten(slots[self.slot])
+        slots[self.slot] = value
+    def home(self, context):
+        # (list, index) or (dict, key) of where the variable is stored,
+        # for storing to it repeatedly
+        depth = self.depth
+        if (depth < 0):
+            (context, slot) = context.find(self.id)
+            if (slot == None):
+                return (context.bindings, self.id)
+            return (context.slots, slot)
+        while (depth > 0):
+            context = context.parent
+            depth -= 1
+        return (context.slots, self.slot)
+    def localSlot(self):
+        return self.slot if (self.depth == 0) else -1
+    def toClosure(self):
+        (id, depth, slot) = (self.id, self.depth, self.slot)
+        if (depth < 0):
+            return lambda context: context.get(id)
+        elif (depth == 0):
+            return lambda context: context.slots[slot]
+        elif (depth == 1):
+            return lambda context: context.parent.slots[slot]
+        return lambda context: self.eval(context)
+    def assignClosure(self):
+        (id, depth, slot) = (self.id, self.depth, self.slot)
+        if (depth < 0):
+            return lambda context, value: context.set(id, value)
+        elif (depth == 0):
+            def assign(context, value):
+                slots = context.slots
+                if (isinstance(slots[slot], FunctionExpr)):
+                    overwritten(slots[slot])
+                slots[slot] = value
+            return assign
+        return self.assign
+    def emit(self, code):
+        if (self.depth < 0):
+            code.emit(OP_LOAD_NAME, code.nameIndex(self.id))
+        elif (self.depth == 0):
+            code.emit(OP_LOAD_LOCAL, self.slot)
+        else:
+            code.emit(OP_LOAD_OUTER, (self.depth << 16) | self.slot)
+    def emitStore(self, code):
+        # store the top of the stack, leaving it there
+        if (self.depth < 0):
+            code.emit(OP_STORE_NAME, code.nameIndex(self.id))
+        elif (self.depth == 0):
+            code.emit(OP_STORE_LOCAL, self.slot)
+        else:
+            code.emit(OP_STORE_OUTER, (self.depth << 16) | self.slot)
+    def propagate(self, facts, stats):
+        if (self.id not in facts):
+            return self
+        stats.count("constants propagated")
+        return Literal(facts[self.id])
+    def toPython(self, gen):
+        if (self.depth < 0):
+            return "%s.get(%r)" % (gen.currentContext(), self.id)
+        frame = gen.frames[-1 - self.depth]
+        if (frame.context == None):
+            return frame.locals[self.slot]
+        return "%s.slots[%d]" % (frame.context, self.slot)
+    def pythonInSlot(self, gen):
+        # whether the variable lives in a slot of a Context, rather than in
+        # a Python local: no call site can have cached what a local holds
+        # (see CallSites), as no lookup by name can find it
+        return (self.depth >= 0 and
+                gen.frames[-1 - self.depth].context != None)
+    def pythonAssign(self, gen, value):
+        # a Python statement storing the expression value; only a store by
+        # name passes what it overwrites to overwritten (see writeAssign)
+        if (self.depth < 0):
+            return "%s.set(%r, %s)" % (gen.currentContext(), self.id, value)
+        frame = gen.frames[-1 - self.depth]
+        if (frame.context == None):
+            return "%s = %s" % (frame.locals[self.slot], value)
+        return "%s.slots[%d] = %s" % (frame.context, self.slot, value)
+    def writeAssign(self, gen, value):
+        # store the expression value, passing a function it overwrites in
+        # a Context's slot to overwritten
+        if (self.pythonInSlot(gen)):
+            if (not value.isidentifier()):
+                # value first: computing it may call (and cache) the old one
+                temp = gen.temp("value")
+                gen.line("%s = %s" % (temp, value))
+                value = temp
+            old = self.toPython(gen)
+            gen.line("if isinstance(%s, FunctionExpr): overwritten(%s)" %
+                     (old, old))
+        gen.line(self.pythonAssign(gen, value))
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
         mark = tokenBuffer.getMark()
-        value = tokenBuffer.get().value
-        if (type(value) == str):
-            return Identifier(value)
+        token = tokenBuffer.get()
+        if (token.kind == TOKEN_ID):
+            return Identifier(token.value)
         tokenBuffer.setMark(mark)
         return None
 
 class Literal(SimpleExpr):
+    __slots__ = ("value",)
     def __init__(self, value):
         self.value = value
     def printTree(self, depth=0):
         print ("  "*depth, type(self).__name__, "value=", self.value)
     def eval(self, context):
         return self.value
+    def isNumeric(self):
+        return isinstance(self.value, (int, float))
+    def toClosure(self):
+        value = self.value
+        return lambda context: value
+    def emit(self, code):
+        code.emit(OP_CONST, code.constant(self.value))
+    def toPython(self, gen):
+        if (type(self.value) == int and self.value.bit_length() > 64):
+            # repr() refuses ints of too many digits (see digitsToInt)
+            return gen.constant(self.value)
+        return repr(self.value)
     @classmethod
+    @packrat
     def parse(cls, tokenBuffer):
         mark = tokenBuffer.getMark()
-        value = tokenBuffer.get().value
-        if (type(value) == int):
-            return Literal(value)
+        token = tokenBuffer.get()
+        if (token.kind == TOKEN_INT):
+            return Literal(token.value)
         tokenBuffer.setMark(mark)
         return None
 
+# LL(1) dispatch: the statement rule selected by a statement's first token
+STMT_RULES = {
+    KW_OUTPUT: OutputStmt,
+    KW_SET: SetStmt,
+    KW_RETURN: ReturnStmt,
+    LBRACE: BlockStmt,
+    KW_VARS: VarsStmt,
+    KW_IF: IfStmt,
+    KW_LOOP: LoopStmt,
+}
+
+##############################################
+## Bytecode Compiler and VM
+##############################################
+
+# The bytecode engine compiles a program (each node's emit method) into
+# CodeObjects: parallel arrays of opcodes and operands, plus tables of
+# constants and names the operands index.  runBytecode executes them
+# with a value stack and an explicit stack of suspended callers, so
+# language calls do not recurse in Python.  Function values are still
+# FunctionExpr nodes, each compiling its body on its first call.
+#
+# It is not faster than the tree walker: dispatching each instruction
+# through an if/elif chain in CPython costs about what a node's eval
+# call does, and benchmarks.py vm measures it at 0.8x on loops and
+# 0.5x-0.7x on calls.  What it buys is the non-recursive call stack,
+# which tail calls build on.
+
+OPNAMES = ["CONST", "LOAD_NAME", "LOAD_LOCAL", "LOAD_OUTER", "STORE_NAME",
+           "STORE_LOCAL", "STORE_OUTER", "POP", "ADD", "SUB", "MUL", "DIV",
+           "MOD", "EQ", "LT", "GT", "JUMP", "JUMP_IF_NE", "ENTER", "LEAVE",
+           "VARS", "OUTPUT", "RANGE", "FOR_ITER", "LOOP_BACK", "CALL",
+           "RETURN", "HALT", "TAIL_CALL", "STORE_NAME_POP", "STORE_LOCAL_POP",
+           "STORE_OUTER_POP"]
+
+(OP_CONST, OP_LOAD_NAME, OP_LOAD_LOCAL, OP_LOAD_OUTER, OP_STORE_NAME,
+ OP_STORE_LOCAL, OP_STORE_OUTER, OP_POP, OP_ADD, OP_SUB, OP_MUL, OP_DIV,
+ OP_MOD, OP_EQ, OP_LT, OP_GT, OP_JUMP, OP_JUMP_IF_NE, OP_ENTER, OP_LEAVE,
+ OP_VARS, OP_OUTPUT, OP_RANGE, OP_FOR_ITER, OP_LOOP_BACK, OP_CALL,
+ OP_RETURN, OP_HALT, OP_TAIL_CALL, OP_STORE_NAME_POP, OP_STORE_LOCAL_POP,
+ OP_STORE_OUTER_POP) = range(len(OPNAMES))
+
+# the opcodes whose operand means something
+OPS_WITH_ARG = set([OP_CONST, OP_LOAD_NAME, OP_LOAD_LOCAL, OP_LOAD_OUTER,
+                    OP_STORE_NAME, OP_STORE_LOCAL, OP_STORE_OUTER, OP_JUMP,
+                    OP_JUMP_IF_NE, OP_ENTER, OP_VARS, OP_FOR_ITER,
+                    OP_LOOP_BACK, OP_CALL, OP_TAIL_CALL, OP_STORE_NAME_POP,
+                    OP_STORE_LOCAL_POP, OP_STORE_OUTER_POP])
+
+BINARY_OPCODES = { "+": OP_ADD, "-": OP_SUB, "*": OP_MUL, "/": OP_DIV,
+                   "%": OP_MOD, "=": OP_EQ, "<": OP_LT, ">": OP_GT }
+
+# the functions of the binary opcodes, indexed by opcode
+BINARY_FUNCTIONS = [None] * len(OPNAMES)
+for (op, opcode) in BINARY_OPCODES.items():
+    BINARY_FUNCTIONS[opcode] = OPERATORS[op][2]
+
+# a store followed by a pop is one instruction
+STORE_POPS = { OP_STORE_NAME: OP_STORE_NAME_POP,
+               OP_STORE_LOCAL: OP_STORE_LOCAL_POP,
+               OP_STORE_OUTER: OP_STORE_OUTER_POP }
+
+class CodeObject(object):
+    def __init__(self, name, function=False):
+        self.name = name
+        self.function = function # a function body, so returns leave it
+        self.ops = array("B")
+        self.args = array("l")
+        self.consts = [ ]
+        self.names = [ ]
+        self.label = 0 # the latest address a jump was patched to
+        self.instructions = None # (op, arg) pairs, once finished
+        self.dynamicNames = None # its program's (see dynamicNames)
+    def emit(self, op, arg=0):
+        # append an instruction, returning its address
+        if (op == OP_POP and len(self.ops) > self.label and
+            self.ops[-1] in STORE_POPS):
+            # no jump lands between the store and the pop
+            self.ops[-1] = STORE_POPS[self.ops[-1]]
+            return len(self.ops) - 1
+        self.ops.append(op)
+        self.args.append(arg)
+        return len(self.ops) - 1
+    def patch(self, at):
+        # point the jump at address "at" to the next instruction
+        self.label = len(self.ops)
+        self.args[at] = self.label
+    def finish(self):
+        # the instructions as runBytecode reads them: one tuple per
+        # instruction is one lookup per dispatch, not two
+        self.instructions = list(zip(self.ops, self.args))
+        return self
+    def constant(self, value):
+        self.consts.append(value)
+        return len(self.consts) - 1
+    def nameIndex(self, varname):
+        if (varname not in self.names):
+            self.names.append(varname)
+        return self.names.index(varname)
+
+# A program's dynamic names are every name that code running in it could
+# look up by name.  A frame holding none of them can be left out of a
+# callee's context chain, since no lookup could stop there: calls on the
+# VM parent their frame to visibleContext(context, names), so the chain
+# (and the lookups walking it) grows only through frames that matter.
+# This is what lets a tail call drop its caller's frames entirely.
+#
+# The names are the program's own identifiers that are not resolved,
+# in its function bodies too, plus those of every function value the
+# program can reach when it starts: a function from an earlier program
+# (say, in GLOBALS) can run here and look up names in our frames.  Each
+# FunctionExpr keeps its program's names for programs after it.  A
+# function of unknown names (one never compiled) means None: no frame
+# is ever left out.
+
+def dynamicNames(ast, context):
+    names = set()
+    functions = [ ]
+    nodes = [ast]
+    for node in nodes:
+        nodes.extend(node.getChildren())
+        if (isinstance(node, Identifier) and node.depth < 0):
+            names.add(node.id)
+        elif (isinstance(node, FunctionExpr)):
+            functions.append(node)
+    while (context != None and names != None):
+        values = list(context.bindings.values())
+        if (context.slots != None):
+            values.extend(context.slots)
+        for value in values:
+            if (isinstance(value, FunctionExpr)):
+                if (value.dynamicNames == None):
+                    names = None
+                    break
+                names.update(value.dynamicNames)
+        context = context.parent
+    for fn in functions:
+        fn.dynamicNames = names
+    return names
+
+def visibleContext(context, names):
+    # context, or the nearest enclosing one a lookup by name could stop at
+    if (names == None):
+        return context
+    while (context.layout != None and not context.bindings and
+           context.parent != None and context.layout.keys().isdisjoint(names)):
+        context = context.parent
+    return context
+
+def compileBytecode(ast, context=GLOBALS):
+    # the program's CodeObject, to run in context
+    code = CodeObject("toplevel")
+    code.dynamicNames = dynamicNames(ast, context)
+    ast.emit(code)
+    code.emit(OP_HALT)
+    return code.finish()
+
+def runBytecode(code, context=GLOBALS):
+    # The dispatch loop is the VM's cost: the most frequent opcodes are
+    # tested first, and the stack's methods and the frame's slots are
+    # kept in locals (slots is refreshed whenever context changes).
+    stack = [ ]
+    push = stack.append
+    pop = stack.pop
+    # (code, pc, context, stack base, memo stores) of each suspended
+    # caller; the memo stores are the (MemoCache, key) pairs that the
+    # callee's result must be stored under when it returns, or None
+    frames = [ ]
+    dynamic = code.dynamicNames # the whole run's, its program's
+    (instructions, consts, names) = (code.instructions, code.consts,
+                                     code.names)
+    slots = context.slots
+    binary = BINARY_FUNCTIONS
+    pc = 0
+    while True:
+        (op, arg) = instructions[pc]
+        pc += 1
+        if (op == OP_LOAD_LOCAL):
+            push(slots[arg])
+        elif (op == OP_CONST):
+            push(consts[arg])
+        elif (op == OP_STORE_LOCAL_POP):
+            slots[arg] = pop()
+        elif (op == OP_LOAD_OUTER):
+            frame = context.parent
+            if (arg >= 0x20000):
+                for i in range((arg >> 16) - 1):
+                    frame = frame.parent
+            push(frame.slots[arg & 0xFFFF])
+        elif (op <= OP_GT and op >= OP_ADD):
+            b = pop()
+            stack[-1] = binary[op](stack[-1], b)
+        elif (op == OP_FOR_ITER):
+            varVal = next(stack[-1], None)
+            if (varVal == None):
+                pop()
+                pc = arg
+            else:
+                push(varVal)
+        elif (op == OP_STORE_OUTER_POP):
+            frame = context.parent
+            if (arg >= 0x20000):
+                for i in range((arg >> 16) - 1):
+                    frame = frame.parent
+            frame.slots[arg & 0xFFFF] = pop()
+        elif (op == OP_JUMP_IF_NE):
+            b = pop()
+            if (pop() != b):
+                pc = arg
+        elif (op == OP_LOOP_BACK):
+            stack[-2] = pop()
+            pc = arg
+        elif (op == OP_JUMP):
+            pc = arg
+        elif (op == OP_POP):
+            pop()
+        elif (op == OP_STORE_LOCAL):
+            slots[arg] = stack[-1]
+        elif (op == OP_STORE_OUTER):
+            frame = context.parent
+            if (arg >= 0x20000):
+                for i in range((arg >> 16) - 1):
+                    frame = frame.parent
+            frame.slots[arg & 0xFFFF] = stack[-1]
+        elif (op == OP_LOAD_NAME):
+            push(context.get(names[arg]))
+        elif (op == OP_STORE_NAME_POP):
+            context.set(names[arg], pop())
+        elif (op == OP_STORE_NAME):
+            context.set(names[arg], stack[-1])
+        elif (op == OP_CALL):
+            (fnName, argc) = consts[arg]
+            fn = pop()
+            if (not isinstance(fn, FunctionExpr)):
+                raise Exception("Not a function: " + fnName)
+            base = len(stack) - argc
+            fnArgs = stack[base:]
+            del stack[base:]
+            stores = None
+            if (fn.memo != None):
+                key = memoKey(fnArgs)
+                result = fn.memo.lookup(key)
+                if (result is not UNBOUND):
+                    push(result)
+                    continue
+                stores = [(fn.memo, key)]
+            fnContext = fn.bind(fnName, fnArgs, visibleContext(context, dynamic))
+            frames.append((code, pc, context, base, stores))
+            code = fn.toBytecode()
+            (instructions, consts, names) = (code.instructions, code.consts,
+                                             code.names)
+            pc = 0
+            context = fnContext
+            slots = context.slots
+        elif (op == OP_TAIL_CALL):
+            # a call in a function's return statement, made in place of
+            # the function: its caller's frame is reused, and the stack
+            # above it (our arguments and loop state) is dropped
+            (fnName, argc) = consts[arg]
+            fn = pop()
+            if (not isinstance(fn, FunctionExpr)):
+                raise Exception("Not a function: " + fnName)
+            fnArgs = stack[len(stack) - argc:]
+            (callerCode, callerPc, callerContext, base, stores) = frames[-1]
+            del stack[base:]
+            if (fn.memo != None):
+                # the callee's result is ours too: return it if it is
+                # known, else remember to store it under both keys
+                key = memoKey(fnArgs)
+                result = fn.memo.lookup(key)
+                if (result is not UNBOUND):
+                    frames.pop()
+                    if (stores != None):
+                        for (memo, storeKey) in stores:
+                            memo.store(storeKey, result)
+                    (code, pc, context) = (callerCode, callerPc, callerContext)
+                    (instructions, consts, names) = (code.instructions,
+                                                     code.consts, code.names)
+                    slots = context.slots
+                    push(result)
+                    continue
+                stores = (stores or [ ]) + [(fn.memo, key)]
+                frames[-1] = (callerCode, callerPc, callerContext, base, stores)
+            context = fn.bind(fnName, fnArgs, visibleContext(context, dynamic))
+            slots = context.slots
+            code = fn.toBytecode()
+            (instructions, consts, names) = (code.instructions, code.consts,
+                                             code.names)
+            pc = 0
+        elif (op == OP_RETURN):
+            value = pop()
+            if (frames == [ ]):
+                # a return at the top level ends the program
+                return ReturnValue(value)
+            (code, pc, context, base, stores) = frames.pop()
+            (instructions, consts, names) = (code.instructions, code.consts,
+                                             code.names)
+            slots = context.slots
+            del stack[base:]
+            if (stores != None):
+                for (memo, key) in stores:
+                    memo.store(key, value)
+            push(value)
+        elif (op == OP_ENTER):
+            context = Context(context, consts[arg])
+            slots = context.slots
+        elif (op == OP_LEAVE):
+            context = context.parent
+            slots = context.slots
+        elif (op == OP_RANGE):
+            toVal = pop()
+            fromVal = pop()
+            step = +1 if (fromVal<toVal) else -1
+            push(None) # the loop's result, if it never runs
+            push(iter(range(fromVal, toVal+step, step)))
+        elif (op == OP_VARS):
+            push(consts[arg].eval(context))
+        elif (op == OP_OUTPUT):
+            print(stack[-1])
+        elif (op == OP_HALT):
+            return pop()
+        else:
+            raise Exception("Bad opcode: " + str(op))
+
+def disassemble(code):
+    # print code, then the bodies of the functions it makes
+    print("code", code.name)
+    functions = [ ]
+    for pc in range(len(code.ops)):
+        (op, arg) = (code.ops[pc], code.args[pc])
+        line = "%5d  %-16s" % (pc, OPNAMES[op])
+        if (op in OPS_WITH_ARG):
+            line += "%6d" % arg
+        if (op == OP_CONST):
+            value = code.consts[arg]
+            if (isinstance(value, FunctionExpr)):
+                functions.append(value)
+                value = value.describe()
+            line += "  (%s)" % (value,)
+        elif (op == OP_CALL or op == OP_TAIL_CALL):
+            line += "  (%s, %d args)" % code.consts[arg]
+        elif (op in (OP_LOAD_NAME, OP_STORE_NAME, OP_STORE_NAME_POP)):
+            line += "  (%s)" % code.names[arg]
+        elif (op in (OP_LOAD_OUTER, OP_STORE_OUTER, OP_STORE_OUTER_POP)):
+            line += "  (depth %d, slot %d)" % (arg >> 16, arg & 0xFFFF)
+        elif (op == OP_ENTER):
+            layout = code.consts[arg]
+            line += "  (%s)" % ("by name" if (layout == None) else
+                                " ".join(sorted(layout, key=layout.get)))
+        elif (op == OP_VARS):
+            line += "  (%s)" % " ".join(code.consts[arg].idList.ids)
+        print(line)
+    for fn in functions:
+        print()
+        disassemble(fn.toBytecode())
+
+def samplePrograms():
+    # (file name, code) of the example programs in this directory
+    import glob
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = [("simpleLanguage.py", code)]
+    for path in sorted(glob.glob(os.path.join(here, "paser*.py"))):
+        with open(path) as f:
+            for sample in re.findall(r'code = """(.*?)"""', f.read(), re.S):
+                samples.append((os.path.basename(path), sample))
+    return samples
+
+##############################################
+## Python Code Generator
+##############################################
+
+# The Python engine transpiles a program to Python source: functions
+# become defs, loops become for loops over range, ifs become ifs.  It
+# is compiled with compile() and run by CPython itself.  Scoping stays
+# dynamic: each def takes its caller's Context, and lookups by name walk
+# real Contexts.  Only frames holding one of the program's dynamic names
+# (see dynamicNames) need a Context, though, or every frame when those
+# are unknown.  All other frames keep their variables in Python locals,
+# since nothing can reach them but the code of their own function.
+
+class PythonFrame(object):
+    # one of the program's frames, as PythonSource keeps it: a Context
+    # in the Python variable "context", or a Python local per slot
+    def __init__(self, context=None, locals=None):
+        self.context = context
+        self.locals = locals
+        self.declared = set() # slots a vars statement has been written for
+
+class PythonSource(object):
+    # The source being written, and the namespace it will run in.  Every
+    # generated function keeps the value of its last statement in _r.
+    def __init__(self, dynamicNames):
+        self.dynamicNames = dynamicNames
+        self.lines = [ ]
+        self.indent = 0
+        self.namespace = { "Context": Context, "ReturnValue": ReturnValue,
+                           "callNative": callNative, "FunctionExpr": FunctionExpr,
+                           "overwritten": overwritten }
+        self.constants = dict()
+        self.count = 0
+        self.frames = [ ] # the frames of the function being written
+        self.base = "context" # its caller's (or the program's) Context
+        self.topLevel = True
+        self.functions = [ ] # FunctionExprs still to write a def for
+        self.natives = [ ] # (FunctionExpr, name of its def)
+    def line(self, text):
+        self.lines.append("    " * self.indent + text)
+    def temp(self, prefix):
+        # a fresh Python name
+        if (not prefix.isidentifier()):
+            prefix = "v"
+        self.count += 1
+        return "%s_%d" % (prefix, self.count)
+    def constant(self, value):
+        # a name for value in the namespace
+        if (value == None):
+            return "None"
+        if (id(value) not in self.constants):
+            name = self.temp(type(value).__name__)
+            self.constants[id(value)] = name
+            self.namespace[name] = value
+        return self.constants[id(value)]
+    def pushFrame(self, layout):
+        if (layout == None or self.dynamicNames == None or
+            any(varname in self.dynamicNames for varname in layout)):
+            frame = PythonFrame(self.temp("context"))
+        else:
+            varnames = sorted(layout, key=layout.get)
+            frame = PythonFrame(None, [self.temp(varname)
+                                       for varname in varnames])
+        self.frames.append(frame)
+        return frame
+    def popFrame(self):
+        self.frames.pop()
+    def currentContext(self):
+        # the innermost Context: frames kept in locals are left out of
+        # the chain, as no lookup by name could find anything in them
+        for frame in reversed(self.frames):
+            if (frame.context != None):
+                return frame.context
+        return self.base
+    def source(self):
+        return "\n".join(self.lines) + "\n"
+
+def callNative(fnName, context, args, fn):
+    # a call from transpiled code, with its arguments already evaluated
+    if (not isinstance(fn, FunctionExpr)):
+        raise Exception("Not a function: " + fnName)
+    if (fn.native == None):
+        return fn.call(fnName, list(args), context)
+    if (len(args) != len(fn.idList.ids)):
+        raise Exception("Wrong # of arguments: " + fnName)
+    memo = fn.memo
+    if (memo == None):
+        return fn.native(context, args)
+    key = memoKey(args)
+    result = memo.lookup(key)
+    if (result is UNBOUND):
+        result = fn.native(context, args)
+        memo.store(key, result)
+    return result
+
+def pythonSource(ast, context=GLOBALS):
+    # a PythonSource holding a module that defines program(context), to
+    # be run in context
+    gen = PythonSource(dynamicNames(ast, context))
+    gen.line("def program(context):")
+    gen.indent = 1
+    ast.writePython(gen, True)
+    gen.line("return _r")
+    gen.topLevel = False
+    written = set()
+    while (gen.functions != [ ]):
+        fn = gen.functions.pop(0)
+        if (id(fn) in written):
+            continue
+        written.add(id(fn))
+        (gen.frames, gen.base, gen.indent) = ([ ], "caller", 0)
+        name = gen.temp("function")
+        gen.natives.append((fn, name))
+        gen.line("")
+        fn.writePythonDef(gen, name)
+    return gen
+
+def transpile(ast, context=GLOBALS):
+    # compile ast to a Python function of the context to run it in
+    gen = pythonSource(ast, context)
+    namespace = gen.namespace
+    exec(compile(gen.source(), "<simpleLanguage>", "exec"), namespace)
+    for (fn, name) in gen.natives:
+        fn.native = namespace[name]
+    program = namespace["program"]
+    if (isinstance(ast, BlockStmt) and ast.topLevel):
+        return lambda context: ast.runProgram(program, context)
+    return program
+
+##############################################
+## Optimizer
+##############################################
+
+# optimizeTree rewrites a parsed program before it is resolved and
+# evaluated: each node's optimize method returns the node to use in its
+# place, and counts what it did in an OptimizerStats.  Folding,
+# propagation and dead code elimination change the tree, so every
+# engine gains from them.  The loop rewrites (hoisted invariants,
+# closed-form accumulators and vectorized reductions) live in
+# LoopStmt's eval and toClosure only: the VM and the Python engine run
+# such loops iteration by iteration.
+
+class OptimizerStats(object):
+    def __init__(self):
+        self.counts = dict()
+        self.referenced = set() # every name an identifier mentions
+    def count(self, what, n=1):
+        self.counts[what] = self.counts.get(what, 0) + n
+    def report(self):
+        for what in sorted(self.counts):
+            print("  %-28s %8d" % (what, self.counts[what]))
+
+def countNodes(ast):
+    nodes = [ast]
+    for node in nodes:
+        nodes.extend(node.getChildren())
+    return len(nodes)
+
+def assignedNames(node):
+    # the names node might set, or None if it makes a call
+    names = set()
+    nodes = [node]
+    for node in nodes:
+        if (isinstance(node, FunctionCall)):
+            return None
+        elif (isinstance(node, (SetStmt, LoopStmt))):
+            names.add(node.identifier.id)
+        if (not isinstance(node, FunctionExpr)):
+            nodes.extend(node.getChildren())
+    return names
+
+def declaredNames(node):
+    # the names vars statements in node declare
+    names = set()
+    nodes = [node]
+    for node in nodes:
+        if (isinstance(node, VarsStmt)):
+            names.update(node.idList.ids)
+        if (not isinstance(node, FunctionExpr)):
+            nodes.extend(node.getChildren())
+    return names
+
+# A loop-invariant expression in a loop's body is replaced by a
+# HoistedExpr, which evaluates it the first time it is needed and then
+# gives the same value until the loop starts again.  Being lazy, it
+# still only runs (and raises) when and if the body gets to it.  The
+# value is kept in the frame the loop runs in (see resetHoisted), not
+# in the node, so the AST can run more than once at a time.  Only eval
+# and the closures hoist: the VM and the Python engine compile the
+# expression as it was.
+class HoistedExpr(Expr):
+    __slots__ = ("expr",)
+    fields = ("expr",)
+    def __init__(self, expr):
+        self.expr = expr
+    def values(self, context):
+        # the cache holding this value: in the frame its loop runs in,
+        # which is context or one enclosing it
+        while True:
+            values = context.hoisted
+            if (values != None and self in values):
+                return values
+            context = context.parent
+    def eval(self, context):
+        values = self.values(context)
+        value = values[self]
+        if (value is UNBOUND):
+            value = values[self] = self.expr.eval(context)
+        return value
+    def toClosure(self):
+        expr = self.expr.toClosure()
+        def run(context):
+            values = self.values(context)
+            value = values[self]
+            if (value is UNBOUND):
+                value = values[self] = expr(context)
+            return value
+        return run
+    def propagate(self, facts, stats):
+        self.expr = self.expr.propagate(facts, stats)
+        return self
+    def containsCall(self):
+        return self.expr.containsCall()
+    def isNumeric(self):
+        return self.expr.isNumeric()
+    def emit(self, code):
+        self.expr.emit(code)
+    def toPython(self, gen):
+        return self.expr.toPython(gen)
+
+def isInvariant(expr, changing):
+    nodes = [expr]
+    for node in nodes:
+        if (isinstance(node, Identifier) and node.id in changing):
+            return False
+        elif (isinstance(node, (FunctionExpr, FunctionCall))):
+            return False
+        nodes.extend(node.getChildren())
+    return True
+
+def hoistInvariants(node, changing, hoisted):
+    # wrap the largest operations in node that read none of the names
+    # in changing, appending the HoistedExprs to hoisted
+    for field in node.fields:
+        value = getattr(node, field)
+        children = value if isinstance(value, tuple) else (value,)
+        replaced = [ ]
+        for child in children:
+            # (an inner loop's HoistedExpr stays as it is, and is wrapped
+            # again if it does not change in this loop either)
+            if (isinstance(child, (BinaryExpr, HoistedExpr)) and
+                isInvariant(child, changing)):
+                child = HoistedExpr(child)
+                hoisted.append(child)
+            elif (child != None and not isinstance(child, FunctionExpr)):
+                hoistInvariants(child, changing, hoisted)
+            replaced.append(child)
+        setattr(node, field,
+                tuple(replaced) if isinstance(value, tuple) else replaced[0])
+
+def affineIn(expr, varnames):
+    # the ints (c1, ..., cn, b) if expr is c1*varnames[0] + ... +
+    # cn*varnames[n-1] + b, with only int literals, else None
+    zeros = (0,) * len(varnames)
+    if (isinstance(expr, Literal) and type(expr.value) == int):
+        return zeros + (expr.value,)
+    elif (isinstance(expr, Identifier)):
+        if (expr.id not in varnames):
+            return None
+        return tuple(int(varname == expr.id) for varname in varnames) + (0,)
+    elif (not isinstance(expr, BinaryExpr) or expr.op not in "+-*"):
+        return None
+    left = affineIn(expr.left, varnames)
+    right = affineIn(expr.right, varnames)
+    if (left == None or right == None):
+        return None
+    elif (expr.op == "+"):
+        return tuple(l + r for (l, r) in zip(left, right))
+    elif (expr.op == "-"):
+        return tuple(l - r for (l, r) in zip(left, right))
+    elif (left[:-1] == zeros):
+        return tuple(left[-1] * r for r in right)
+    elif (right[:-1] == zeros):
+        return tuple(l * right[-1] for l in left)
+    return None
+
+def accumulatorOf(setStmt, varname):
+    # (setStmt, a, b) if setStmt is acc = acc + a*varname + b (in any
+    # arrangement), else None
+    acc = setStmt.identifier.id
+    if (acc == varname):
+        return None
+    affine = affineIn(setStmt.expr, (acc, varname))
+    if (affine == None or affine[0] != 1):
+        return None
+    return (setStmt,) + affine[1:]
+
+def optimizeTree(ast, stats=None):
+    if (stats == None):
+        stats = OptimizerStats()
+    nodes = [ast]
+    for node in nodes:
+        nodes.extend(node.getChildren())
+        if (isinstance(node, Identifier)):
+            stats.referenced.add(node.id)
+    before = len(nodes)
+    ast = ast.optimize(stats)
+    after = countNodes(ast)
+    stats.count("nodes before", before)
+    stats.count("nodes after", after)
+    stats.count("nodes eliminated", before - after)
+    return ast
+
+##############################################
+## Memoization
+##############################################
+
+# memoizePure gives each pure function in a program a MemoCache of its
+# results.  Function values are found through names, by lookups that
+# are dynamic, so a "function name" is one whose only assignment in the
+# program is a set to a function expression, and which is never a
+# parameter, a loop variable or declared in more than one vars list:
+# every lookup of it then finds that function, or fails.  A function is
+# pure if it outputs nothing, sets and reads only its own variables
+# (reading function names aside), and calls only pure functions through
+# function names.  Its result then depends on its arguments alone.
+# Every engine consults the cache on each call: eval and the closures
+# as they call the function, the VM in its CALL and TAIL_CALL
+# instructions and transpiled code in callNative.
+
+from collections import OrderedDict
+
+MEMO_SIZE = 4096
+
+class MemoCache(object):
+    # the results of the last maxsize distinct calls, least recently used
+    # dropped first
+    def __init__(self, maxsize=MEMO_SIZE):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    def lookup(self, key):
+        # the remembered result, or UNBOUND
+        result = self.results.get(key, UNBOUND)
+        if (result is UNBOUND):
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.results.move_to_end(key)
+        return result
+    def store(self, key, result):
+        self.results[key] = result
+        if (len(self.results) > self.maxsize):
+            self.results.popitem(last=False)
+
+def memoKey(args):
+    # the types too, so that f(1) and f(1.0) are told apart
+    return (tuple(args), tuple(map(type, args)))
+
+def functionNames(ast):
+    # {name: FunctionExpr} of the program's function names
+    assigned = dict()
+    declared = dict()
+    excluded = set()
+    nodes = [ast]
+    for node in nodes:
+        nodes.extend(node.getChildren())
+        if (isinstance(node, SetStmt)):
+            assigned.setdefault(node.identifier.id, [ ]).append(node.expr)
+        elif (isinstance(node, LoopStmt)):
+            excluded.add(node.identifier.id)
+        elif (isinstance(node, VarsStmt)):
+            for varname in node.idList.ids:
+                declared[varname] = declared.get(varname, 0) + 1
+        elif (isinstance(node, FunctionExpr)):
+            excluded.update(node.idList.ids)
+    return dict((varname, exprs[0]) for (varname, exprs) in assigned.items()
+                if (len(exprs) == 1 and isinstance(exprs[0], FunctionExpr) and
+                    declared.get(varname, 0) <= 1 and
+                    varname not in excluded))
+
+def isPureBody(fn, functions, pure):
+    nodes = [fn.block]
+    for node in nodes:
+        if (isinstance(node, OutputStmt)):
+            return False
+        elif (isinstance(node, (SetStmt, LoopStmt)) and
+              node.identifier.depth < 0):
+            return False
+        elif (isinstance(node, FunctionCall)):
+            identifier = node.identifier
+            if (identifier.depth >= 0 or identifier.id not in pure):
+                return False
+        elif (isinstance(node, Identifier)):
+            if (node.depth < 0 and node.id not in functions):
+                return False
+        if (not isinstance(node, FunctionExpr)):
+            # (a function made here only runs when called, and any call
+            # of it is checked where it is made)
+            nodes.extend(node.getChildren())
+    return True
+
+def memoizePure(ast, maxsize=MEMO_SIZE):
+    # give ast's pure functions MemoCaches; returns {name: MemoCache}
+    functions = functionNames(ast)
+    pure = set(functions)
+    changed = True
+    while (changed):
+        changed = False
+        for varname in list(pure):
+            if (not isPureBody(functions[varname], functions, pure)):
+                pure.discard(varname)
+                changed = True
+    caches = dict()
+    for varname in pure:
+        functions[varname].memo = caches[varname] = MemoCache(maxsize)
+    return caches
+
+##############################################
+## Vectorized Reductions
+##############################################
+
+# A loop whose body is one set of the form acc = acc + E1 - E2 ..., where
+# the terms are integer arithmetic on the loop variable (and on names
+# the loop leaves alone, and calls of functions that just return such
+# arithmetic), is a reduction.  With NumPy, reduce evaluates each term
+# over numpy.arange of the loop's values, VECTOR_CHUNK values at a time,
+# and sums it.  Every step is first bounded, with exact ints, for all
+# the loop's values, and anything that might not fit in an int64 (or
+# isn't an int, or might divide by zero) leaves the loop to the
+# interpreter before any array is made.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+VECTOR_MIN = 64 # shorter loops aren't worth making arrays for
+VECTOR_CHUNK = 1 << 16 # the most values in one array
+INT64_MAX = 2**63 - 1
+
+def sumTerms(expr):
+    # [(sign, term)] with expr == the sum of the sign*term
+    if (isinstance(expr, BinaryExpr) and expr.op in "+-"):
+        right = sumTerms(expr.right)
+        if (expr.op == "-"):
+            right = [(-sign, term) for (sign, term) in right]
+        return sumTerms(expr.left) + right
+    return [(+1, expr)]
+
+def isArithmetic(expr, acc):
+    # int arithmetic and calls, not mentioning acc
+    if (isinstance(expr, Literal)):
+        return type(expr.value) == int
+    elif (isinstance(expr, Identifier)):
+        return expr.id != acc
+    elif (isinstance(expr, BinaryExpr)):
+        return (expr.op in "+-*%" and isArithmetic(expr.left, acc) and
+                isArithmetic(expr.right, acc))
+    elif (isinstance(expr, FunctionCall)):
+        return (expr.identifier.id != acc and
+                all(isArithmetic(arg, acc) for arg in expr.exprList.exprs))
+    return False
+
+def reductionOf(setStmt, varname):
+    # (setStmt, [(sign, term)]) if setStmt is acc = acc + the terms'
+    # sum, else None
+    acc = setStmt.identifier.id
+    if (acc == varname):
+        return None
+    terms = sumTerms(setStmt.expr)
+    accTerms = [i for (i, (sign, term)) in enumerate(terms)
+                if (isinstance(term, Identifier) and term.id == acc)]
+    if (len(accTerms) != 1 or terms[accTerms[0]][0] != +1):
+        return None
+    del terms[accTerms[0]]
+    if (not all(isArithmetic(term, acc) for (sign, term) in terms)):
+        return None
+    return (setStmt, terms)
+
+class Vectorizer(object):
+    # evaluates a reduction's terms for all of a loop's values at once:
+    # each value is (x, lo, hi), x an int or an int64 array and lo..hi
+    # bounding it, or None if the interpreter has to do it
+    def __init__(self, context, varname, values, acc):
+        self.context = context
+        self.acc = acc
+        self.scope = {varname: values}
+        self.active = set() # the functions being inlined
+    def bounded(self, x, lo, hi):
+        if (lo < -INT64_MAX or hi > INT64_MAX):
+            return None
+        return (x, lo, hi)
+    def leaf(self, value):
+        if (type(value) != int):
+            return None
+        return self.bounded(value, value, value)
+    def value(self, expr, inFunction=False):
+        if (isinstance(expr, Literal)):
+            return self.leaf(expr.value)
+        elif (isinstance(expr, Identifier)):
+            if (expr.id in self.scope):
+                return self.scope[expr.id]
+            elif (expr.id == self.acc):
+                return None
+            try:
+                if (inFunction):
+                    # found in the caller's context, scoping being
+                    # dynamic
+                    return self.leaf(self.context.get(expr.id))
+                return self.leaf(expr.eval(self.context))
+            except Exception:
+                return None
+        elif (isinstance(expr, BinaryExpr)):
+            left = self.value(expr.left, inFunction)
+            if (left == None):
+                return None
+            right = self.value(expr.right, inFunction)
+            if (right == None):
+                return None
+            return self.operate(expr.op, left, right)
+        elif (isinstance(expr, FunctionCall)):
+            return self.call(expr, inFunction)
+        return None
+    def operate(self, op, left, right):
+        ((a, alo, ahi), (b, blo, bhi)) = (left, right)
+        if (op == "+"):
+            return self.bounded(a + b, alo + blo, ahi + bhi)
+        elif (op == "-"):
+            return self.bounded(a - b, alo - bhi, ahi - blo)
+        elif (op == "*"):
+            corners = (alo * blo, alo * bhi, ahi * blo, ahi * bhi)
+            if (min(corners) < -INT64_MAX or max(corners) > INT64_MAX):
+                return None
+            return (a * b, min(corners), max(corners))
+        elif (op == "%" and (blo > 0 or bhi < 0)):
+            if (blo > 0):
+                return (a % b, 0, bhi - 1)
+            return (a % b, blo + 1, 0)
+        return None
+    def call(self, expr, inFunction):
+        # a call of a function that only returns arithmetic on its
+        # parameters is that arithmetic, on the arguments' values
+        scope = self.scope
+        if (inFunction and expr.identifier.id in scope):
+            # a parameter of the function being inlined, not a function
+            # the interpreter could find in the context
+            return None
+        try:
+            if (inFunction):
+                fn = self.context.get(expr.identifier.id)
+            else:
+                fn = expr.identifier.eval(self.context)
+        except Exception:
+            return None
+        args = expr.exprList.exprs
+        if (not isinstance(fn, FunctionExpr) or fn in self.active or
+            len(fn.idList.ids) != len(args) or len(fn.block.stmts) != 1 or
+            not isinstance(fn.block.stmts[0], ReturnStmt) or
+            not isArithmetic(fn.block.stmts[0].expr, self.acc)):
+            return None
+        values = [ ]
+        for arg in args:
+            values.append(self.value(arg, inFunction))
+            if (values[-1] == None):
+                return None
+        self.active.add(fn)
+        self.scope = dict(scope)
+        self.scope.update(zip(fn.idList.ids, values))
+        try:
+            return self.value(fn.block.stmts[0].expr, True)
+        finally:
+            self.active.discard(fn)
+            self.scope = scope
+    def sum(self, n, term):
+        # the sum of term's n values, or None
+        value = self.value(term)
+        if (value == None):
+            return None
+        (x, lo, hi) = value
+        if (type(x) == int):
+            return n * x
+        elif (n * max(-lo, hi) > INT64_MAX):
+            return None
+        return int(x.sum())
+
+##############################################
+## Inline Caches
+##############################################
+
+# Each FunctionCall has a CallSiteCache of the function its name was last
+# found to be, so that the tree and closure engines can skip walking the
+# context chain (from the deepest frame of a recursion to the program's
+# top) to find it again.  A program's call sites are registered in its
+# CallSites when it is resolved.  A cache holds while the version of
+# its CallSites' group does not change, and the stores change it
+# themselves whenever a called name might come to mean something else:
+# a store overwrites a function value (see overwritten), a top-level
+# vars statement declares a name, or a program starts running.
+#
+# Scoping is dynamic, so a function's frame, or an inner block's, can
+# bind a name for whatever it calls.  A call site never caches a name
+# any parameter or such vars statement declares (its group's
+# shadowing), and nothing can then come between its frame and where the
+# name is found.  The function values a program can reach when it
+# starts may come from other programs, whose code then runs alongside
+# ours: start merges their CallSites' groups with ours, which share
+# their shadowing names and are invalidated as a whole.  When the run
+# finishes our CallSites leaves the group again, so that programs that
+# come and go (each line of the REPL, say) do not pile up in it.
+
+import itertools
+
+INLINE_CACHES = True # give registered call sites CallSiteCaches
+CALL_SITE_VERSIONS = itertools.count() # never the same version twice
+
+class CallSiteGroup(object):
+    # the CallSites whose code runs together, and what they share
+    def __init__(self, sites):
+        self.version = next(CALL_SITE_VERSIONS)
+        self.shadowing = set(sites.shadowing)
+        self.members = {id(sites): sites}
+
+class CallSites(object):
+    def __init__(self, ast):
+        self.shadowing = set() # every parameter and non-top-level vars name
+        self.register(ast, INLINE_CACHES)
+        self.group = CallSiteGroup(self)
+    def register(self, ast, caching):
+        # take in ast's functions, vars statements and (if caching) call
+        # sites; the vars statements at the top of a program hide names
+        # from the context it runs in, and any others shadow them
+        top = set()
+        if (isinstance(ast, BlockStmt) and ast.topLevel):
+            top = set(id(stmt) for stmt in ast.stmts)
+        nodes = [ast]
+        for node in nodes:
+            nodes.extend(node.getChildren())
+            if (isinstance(node, FunctionExpr)):
+                node.callSites = self
+                self.shadowing.update(node.idList.ids)
+            elif (isinstance(node, VarsStmt)):
+                if (id(node) in top):
+                    node.callSites = self
+                else:
+                    self.shadowing.update(node.idList.ids)
+            elif (isinstance(node, FunctionCall) and caching):
+                node.cache = CallSiteCache(self)
+    def invalidate(self):
+        # a cached function may have been overwritten or hidden
+        self.group.version = next(CALL_SITE_VERSIONS)
+    def start(self, context):
+        # the program starts running in context: join the group of every
+        # function value it can reach there, and drop the caches filled
+        # in any earlier run
+        group = self.group
+        while (context != None):
+            values = list(context.bindings.values())
+            if (context.slots != None):
+                values.extend(context.slots)
+            for value in values:
+                if (isinstance(value, FunctionExpr)):
+                    if (value.callSites == None):
+                        # from a program never registered
+                        self.register(value, False)
+                    other = value.callSites.group
+                    if (other is not group):
+                        for sites in other.members.values():
+                            sites.group = group
+                        group.members.update(other.members)
+                        group.shadowing.update(other.shadowing)
+            context = context.parent
+        group.shadowing.update(self.shadowing)
+        self.invalidate()
+    def finish(self):
+        # the run is over: leave the group, dropping whatever its caches
+        # found in our frames
+        group = self.group
+        if (len(group.members) > 1):
+            self.invalidate()
+            del group.members[id(self)]
+            self.group = CallSiteGroup(self)
+
+def overwritten(value):
+    # value is about to be replaced where it is stored: if it is a
+    # function, a call site may have cached it
+    if (isinstance(value, FunctionExpr) and value.callSites != None):
+        value.callSites.invalidate()
+
+class CallSiteCache(object):
+    __slots__ = ("sites", "version", "fn", "hits", "misses")
+    def __init__(self, sites):
+        self.sites = sites # its program's CallSites
+        self.version = -1 # never current
+        self.fn = None
+        self.hits = 0
+        self.misses = 0
+    def fill(self, fn):
+        self.version = self.sites.group.version
+        self.fn = fn
+        self.misses += 1
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return 0.0 if (lookups == 0) else self.hits / lookups
+
+def callSiteStats(ast):
+    # [(name, hits, misses)] for each of ast's call sites that has been
+    # cached, in tree order
+    stats = [ ]
+    nodes = [ast]
+    for node in nodes:
+        nodes.extend(node.getChildren())
+        if (isinstance(node, FunctionCall) and node.cache != None and
+            node.cache.hits + node.cache.misses > 0):
+            stats.append((node.identifier.id, node.cache.hits,
+                          node.cache.misses))
+    return stats
+
+def reportCallSites(ast):
+    (hits, misses) = (0, 0)
+    for (fnName, siteHits, siteMisses) in callSiteStats(ast):
+        print("  %-20s %10d hits %8d misses %6.1f%%" %
+              (fnName, siteHits, siteMisses,
+               100.0 * siteHits / (siteHits + siteMisses)))
+        (hits, misses) = (hits + siteHits, misses + siteMisses)
+    if (hits + misses > 0):
+        print("  %-20s %10d hits %8d misses %6.1f%%" %
+              ("all call sites", hits, misses,
+               100.0 * hits / (hits + misses)))
+
 ##############################################
 ## Top-Level Parsing and REPL (Read-Eval-Print Loop)
 ##############################################
 
-def parseTopLevelBlock(code):
-    tokenBuffer = Buffer(tokenize(code), EOF_TOKEN)
-    result = BlockStmt.parse(tokenBuffer, True)
+def parseTopLevelBlock(code, engine="buffer", packrat=False, predictive=True,
+                       optimize=False, memoize=False):
+    tokenBuffer = makeTokenBuffer(tokenize(code, engine), packrat, predictive)
+    return parseTopLevelBuffer(tokenBuffer, True, optimize, memoize)
+
+def makeTokenBuffer(tokens, packrat=False, predictive=True):
+    if (isinstance(tokens, TokenArray)):
+        tokenBuffer = CompactBuffer(tokens, EOF_TOKEN)
+    else:
+        tokenBuffer = Buffer(tokens, EOF_TOKEN)
+    if (packrat):
+        tokenBuffer.memo = dict()
+    tokenBuffer.predictive = predictive
+    return tokenBuffer
+
+def parseStream(stream, chunkSize=STREAM_CHUNK):
+    # parse straight off a file object or chunk iterable (see iterTokens)
+    tokens = iterTokens(stream, chunkSize)
+    return parseTopLevelBuffer(StreamBuffer(tokens, EOF_TOKEN))
+
+def parseFile(path):
+    # lex the file through a read-only memory map (see iterMappedTokens)
+    with open(path, "rb") as f:
+        if (os.fstat(f.fileno()).st_size == 0):
+            return parseTopLevelBlock("")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            tokens = iterMappedTokens(data)
+            try:
+                return parseTopLevelBuffer(StreamBuffer(tokens, EOF_TOKEN))
+            finally:
+                tokens.close()
+
+def parseTopLevelBuffer(tokenBuffer, resolve=True, optimize=False,
+                        memoize=False):
+    # optimize: run optimizeTree, or pass an OptimizerStats to count in;
+    # memoize: give pure functions caches (see memoizePure)
+    installed = installPackrat() if (tokenBuffer.memo != None) else [ ]
+    try:
+        result = BlockStmt.parse(tokenBuffer, True)
+    finally:
+        removePackrat(installed)
     if (tokenBuffer.peek() != EOF_TOKEN):
         raise Exception("extra input: " + str(tokenBuffer.get()))
+    if (optimize):
+        stats = optimize if isinstance(optimize, OptimizerStats) else None
+        result = optimizeTree(result, stats)
+    if (resolve):
+        result.resolve(None)
+        if (memoize):
+            memoizePure(result)
     return result
 
+# The engines that can run a parsed program: "tree" walks the AST with
+# eval, "closure" compiles it with toClosure first, "vm" compiles it to
+# bytecode for runBytecode, and "python" transpiles it to Python.
+def evalTopLevel(ast, context=GLOBALS, engine="tree"):
+    if (engine == "tree"):
+        result = ast.eval(context)
+    elif (engine == "closure"):
+        result = ast.toClosure()(context)
+    elif (engine == "vm"):
+        result = runBytecode(compileBytecode(ast, context), context)
+    elif (engine == "python"):
+        result = transpile(ast, context)(context)
+    else:
+        raise Exception("Unknown engine: " + engine)
+    return topLevelValue(result)
+
 def parseStmtOrExpr(code, tryExpr=False):
     tokenBuffer = Buffer(tokenize(code), EOF_TOKEN)
     result = Stmt.parse(tokenBuffer)
@@ -593,19 +3159,25 @@ def parseStmtOrExpr(code, tryExpr=False):
         result = Expr.parse(tokenBuffer)
     if (tokenBuffer.peek() != EOF_TOKEN):
         raise Exception("extra input: " + str(tokenBuffer.get()))
+    if (result != None):
+        # a program of one statement, evaluated straight in GLOBALS: no
+        # names are known statically, and it makes no frame of its own
+        result = BlockStmt(result, topLevel=True)
+        result.scoped = False
+        result.resolve(None)
     return result
 
-import sys, traceback
+import traceback
 def repl():
     print ("**************************************************")
     print ("Read-Eval-Print loop ('quit' or 'exit' when done).")
     while True:
-        code = raw_input("--> ")
+        code = input("--> ")
         if (code in ["quit", "exit"]):
             break
         try:
             ast = parseStmtOrExpr(code, True)
-            output = ast.eval(GLOBALS)
+            output = topLevelValue(ast.eval(GLOBALS))
             print (output)
         except Exception as error:
             print ("Error:", error)
@@ -0,0 +1,197 @@
+import contextlib
+import io
+import itertools
+import os
+import re
+import tempfile
+import unittest
+from unittest import mock
+
+import simpleLanguage
+
+ENGINES = ("tree", "closure", "vm", "python")
+
+LEXERS = ("buffer", "dfa", "compact", "stream", "mapped")
+
+# programs for the paths the samples barely touch: loops the optimizer
+# rewrites, pure recursion to memoize, calls to cache, and errors
+PROGRAMS = [
+    "vars(s i k) set k to 7 set s to 0 "
+    "loop i from 1 to 1000 { set s to s + i * k % 5 } output s output i",
+    "vars(s i f) set f to function(x) { return x * x * 3 - x } set s to 5 "
+    "loop i from 0 to 1000 { set s to s + f(i) - i } output s",
+    "vars(s i) set s to 0 loop i from 100 to 0 - 100 { set s to i * 2 - s } "
+    "output s",
+    "vars(fib) set fib to function(n) { if n is 0 then { return 0 } "
+    "if n is 1 then { return 1 } return fib(n-1) + fib(n-2) } output fib(20)",
+    "vars(f g) set f to function() { return 1 } "
+    "set g to function() { return f() } output g() "
+    "set f to function() { return 2 } output g()",
+    "vars(s i) set s to 0 loop i from 0 to 10 { set s to s + i % 0 } output s",
+    "vars(g h i s) set s to 0 set g to function(x) { return x + 1 } "
+    "set h to function(g) { return g(1) } "
+    "loop i from 1 to 100 { set s to s + h(i) } output s",
+    "output " + "9" * 5000 + " % 1000",
+]
+
+def parseFileText(code):
+    # parseFile on a file holding code
+    with tempfile.NamedTemporaryFile("w", suffix=".sl", delete=False) as f:
+        f.write(code)
+    try:
+        return simpleLanguage.parseFile(f.name)
+    finally:
+        os.remove(f.name)
+
+# every way to parse a program; the stream's tiny chunks split lexemes
+PARSERS = {
+    "default": simpleLanguage.parseTopLevelBlock,
+    "dfa": lambda code: simpleLanguage.parseTopLevelBlock(code, "dfa"),
+    "compact": lambda code: simpleLanguage.parseTopLevelBlock(code, "compact"),
+    "packrat": lambda code: simpleLanguage.parseTopLevelBlock(
+        code, packrat=True),
+    "backtracking": lambda code: simpleLanguage.parseTopLevelBlock(
+        code, predictive=False),
+    "packrat backtracking": lambda code: simpleLanguage.parseTopLevelBlock(
+        code, packrat=True, predictive=False),
+    "optimize": lambda code: simpleLanguage.parseTopLevelBlock(
+        code, optimize=True),
+    "memoize": lambda code: simpleLanguage.parseTopLevelBlock(
+        code, memoize=True),
+    "optimize memoize": lambda code: simpleLanguage.parseTopLevelBlock(
+        code, optimize=True, memoize=True),
+    "stream": lambda code: simpleLanguage.parseStream(io.StringIO(code), 5),
+    "file": parseFileText,
+}
+
+# module settings to run under (without numpy there is no vectorizer)
+SETTINGS = {
+    "defaults": {},
+    "no inline caches": {"INLINE_CACHES": False},
+    "no numpy": {"numpy": None},
+}
+
+@contextlib.contextmanager
+def settings(name):
+    with contextlib.ExitStack() as stack:
+        for (attribute, value) in SETTINGS[name].items():
+            stack.enter_context(mock.patch.object(simpleLanguage, attribute,
+                                                  value))
+        yield
+
+def runWith(ast, engine):
+    # what the program prints on engine, ending with its error if any;
+    # a function value prints the same whichever parse of it that is
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            simpleLanguage.evalTopLevel(ast, simpleLanguage.Context(), engine)
+        except Exception as error:
+            print("Error:", error)
+    return re.sub(r" at 0x[0-9a-f]+>", ">", output.getvalue())
+
+def runAfter(lines, code, engine, **options):
+    # what code prints on engine, run after REPL lines set up its globals
+    # (options are parseTopLevelBlock's)
+    context = simpleLanguage.Context()
+    for line in lines:
+        simpleLanguage.evalTopLevel(simpleLanguage.parseStmtOrExpr(line),
+                                    context)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            simpleLanguage.evalTopLevel(
+                simpleLanguage.parseTopLevelBlock(code, **options), context,
+                engine)
+        except Exception as error:
+            print("Error:", error)
+    return output.getvalue()
+
+def lexWith(code, lexer):
+    # the (kind, value) of each token lexer finds in code, or "error"
+    try:
+        if (lexer == "stream"):
+            tokens = simpleLanguage.iterTokens(io.StringIO(code), 3)
+        elif (lexer == "mapped"):
+            tokens = simpleLanguage.iterMappedTokens(code.encode())
+        else:
+            tokens = simpleLanguage.tokenize(code, lexer)
+        return [(token.kind, token.value) for token in tokens]
+    except Exception:
+        return "error"
+
+class LexerTest(unittest.TestCase):
+    # every lexer must find the same tokens, and fail on the same input
+    def testLexersAgree(self):
+        inputs = [sample for (name, sample) in simpleLanguage.samplePrograms()]
+        inputs += ["\u00bdx", "x\u00bd", "\u00b2", "\u216b", "1\u00b2",
+                   "a\u00b2b", "\u00f11 \u00fc", "12ab", "x ; note\n y", "#"]
+        for (i, code) in enumerate(inputs):
+            expected = lexWith(code, "buffer")
+            for lexer in LEXERS[1:]:
+                with self.subTest(input=i, lexer=lexer):
+                    self.assertEqual(lexWith(code, lexer), expected)
+
+class ConformanceTest(unittest.TestCase):
+    # every sample program in this directory, and each of PROGRAMS, must
+    # print the same (and fail with the same error) however it is parsed,
+    # under any settings, on every engine
+    def testProgramsAgreeEverywhere(self):
+        samples = simpleLanguage.samplePrograms()
+        self.assertTrue(len(samples) > 1)
+        programs = [sample for (name, sample) in samples] + PROGRAMS
+        for (i, program) in enumerate(programs):
+            expected = runWith(simpleLanguage.parseTopLevelBlock(program),
+                               "tree")
+            for (parser, setting, engine) in itertools.product(
+                    PARSERS, SETTINGS, ENGINES):
+                with self.subTest(program=i, parser=parser, setting=setting,
+                                  engine=engine), settings(setting):
+                    ast = PARSERS[parser](program)
+                    self.assertEqual(runWith(ast, engine), expected)
+
+class RegressionTest(unittest.TestCase):
+    def assertPrints(self, lines, code, expected, **options):
+        for engine in ENGINES:
+            with self.subTest(engine=engine, **options):
+                self.assertEqual(runAfter(lines, code, engine, **options),
+                                 expected)
+    def testEarlierFunctionSeesCallersFrame(self):
+        # g looks up f in the frames of whatever calls it
+        self.assertPrints(["vars(g)", "set g to function(){return f()}"],
+                          "vars(f) set f to function(){return 1} output g()",
+                          "1\n")
+    def testHugeLiteral(self):
+        self.assertPrints([], "output " + "9" * 5000 + " % 1000", "999\n")
+    def testInlinedParameterIsNoCallee(self):
+        # h's g is its argument, not the function g (vectorized with numpy)
+        code = ("vars(g h i s) set s to 0 "
+                "set g to function(x){return x+1} "
+                "set h to function(g){return g(1)} "
+                "loop i from 1 to 100 { set s to s + h(i) } output s")
+        for optimize in (False, True):
+            self.assertPrints([], code, "Error: Not a function: g\n",
+                              optimize=optimize)
+    def testStoreDropsEarlierFunctionsCache(self):
+        # g's call of f must see each new f, whatever stores it
+        self.assertPrints(["vars(g f)", "set f to function(){return 1}",
+                           "set g to function(){return f()}"],
+                          "vars(f h) set h to function(){return f()} "
+                          "set f to function(){return 2} output g() "
+                          "set f to function(){return 3} output g()",
+                          "2\n3\n")
+    def testReplLinesLeaveCallSiteGroups(self):
+        context = simpleLanguage.Context()
+        for line in ["vars(x f)", "set x to 0",
+                     "set f to function(n){return n+1}"]:
+            simpleLanguage.evalTopLevel(simpleLanguage.parseStmtOrExpr(line),
+                                        context)
+        for i in range(100):
+            simpleLanguage.evalTopLevel(
+                simpleLanguage.parseStmtOrExpr("set x to f(x)"), context)
+        self.assertEqual(context.get("x"), 100)
+        group = context.get("f").callSites.group
+        self.assertEqual(len(group.members), 1)
+
+if (__name__ == "__main__"):
+    unittest.main()